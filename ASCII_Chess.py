@@ -6,11 +6,36 @@ This programs lets you play a chess on a text interface terminal.
 More practice with OOP and hopefully a first step in making a 
 full-fledged chess game with AI.
 """
+import argparse
+import asyncio
+import contextlib
+import functools
+import itertools
+import json
+import mmap
+import os
+import random
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from array import array
+from collections import Counter, OrderedDict
+
 import colored
 from colored import stylize
 
+# NumPy is optional, it only speeds up check_then_move_batch()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Board():
-    "Board containing an 8x8 two dimensional list"
+    "Board containing an 8x8 two dimensional list, mirrored by 64 bit integers (bitboards)"
 
     def __init__(self):
         self.positions = [
@@ -24,6 +49,61 @@ class Board():
                             [' ', ' ', ' ', ' ', ' ', ' ', ' ', ' '],
                          ]
 
+        # Bit number (row * 8 + column) is set when a piece of that team and type is on that space
+        self.bitboards = {}
+        for team in ('white', 'black'):
+            for piece_type in (Pawn, Rook, Knight, Bishop, Queen, King):
+                self.bitboards[(team, piece_type)] = 0
+
+        # The pieces of each team and type that are on the board, keyed by their coordinates, so that
+        # looking at every piece never has to look at the empty spaces
+        self.piece_lists = {}
+        for team in ('white', 'black'):
+            for piece_type in (Pawn, Rook, Knight, Bishop, Queen, King):
+                self.piece_lists[(team, piece_type)] = {}
+
+        # Every space occupied by each team
+        self.occupied = {'white': 0, 'black': 0}
+
+        # Position of each team's king, None while it has none
+        self.king_positions = {'white': None, 'black': None}
+
+        # One small int per space (0 for empty, otherwise PIECE_CODES[type] + TEAM_CODES[team]), so hot loops can
+        # look a space up without touching Piece objects
+        self.squares = bytearray(64)
+
+        # Team whose turn it is
+        self.turn = 'white'
+
+        # Zobrist hash of the position, updated with every piece that is added or removed and every change of turn
+        self.hash = 0
+
+        # Material plus piece-square scores (white minus black) for the opening and the endgame, and how much of
+        # the opening is left (GAME_PHASE_TOTAL with every piece on the board). Updated with every piece added or removed
+        self.opening_score = 0
+        self.endgame_score = 0
+        self.game_phase = 0
+
+        # Hashes of the positions the game has been in, in order, and how many times each one has been seen, so
+        # the search can ask if a position already happened without scanning the whole game
+        self.position_history = []
+        self.position_counts = Counter()
+
+        # Moves played in the game, as (selected position, destination position, promotion), and the FEN of
+        # the position before the first of them
+        self.move_history = []
+        self.start_fen = None
+
+        # The rest of a FEN. The game has no castling or en passant, so those two are only kept so
+        # that a position read from a FEN is written back out the same
+        self.castling_rights = '-'
+        self.en_passant = '-'
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+
+        # Legal moves of recently seen positions, keyed by (hash, team), least recently used first
+        self.move_cache = OrderedDict()
+
     def coords_to_piece(self, coordinates):
         """
         Input: tuple containing two ints\n
@@ -40,13 +120,18 @@ class Board():
         Output: list of Piece objects
         """
         pieces = []
-        for x in range(len(self.positions)):
-            for y in range(len(self.positions[0])):
-                space = self.coords_to_piece((x, y))
-                if isinstance(space, Piece):
-                    selected_piece = space
-                    if selected_piece.team == team:
-                        pieces.append(selected_piece)
+        for piece_type in (Pawn, Rook, Knight, Bishop, Queen, King):
+            pieces.extend(self.piece_lists[(team, piece_type)].values())
+        return pieces
+
+    def piece_list_of_types(self, team, *piece_types):
+        """
+        Input: str == either 'black' or 'white', one or more Piece classes\n
+        Output: list of Piece objects of those types
+        """
+        pieces = []
+        for piece_type in piece_types:
+            pieces.extend(self.piece_lists[(team, piece_type)].values())
         return pieces
 
     def update(self, piece):
@@ -57,14 +142,392 @@ class Board():
         move = piece.position
         index1 = move[0]
         index2 = move[1]
+        self.remove_from_bitboards(self.positions[index1][index2], move)
         self.positions[index1][index2] = piece
+        self.add_to_bitboards(piece, move)
+        piece.board = self
+
+    def clear(self, coordinates):
+        """
+        Input: tuple containing two ints\n
+        Empties the space at the coordinates
+        """
+        self.remove_from_bitboards(self.positions[coordinates[0]][coordinates[1]], coordinates)
+        self.positions[coordinates[0]][coordinates[1]] = ' '
+
+    def add_to_bitboards(self, piece, coordinates):
+        """
+        Input: Piece object, tuple containing two ints\n
+        Sets the bit of the space in the bitboards of the piece's team and type
+        """
+        square = coords_to_square(coordinates)
+        bit = 1 << square
+        self.bitboards[(piece.team, type(piece))] |= bit
+        self.piece_lists[(piece.team, type(piece))][coordinates] = piece
+        self.occupied[piece.team] |= bit
+        self.squares[square] = PIECE_CODES[type(piece)] | TEAM_CODES[piece.team]
+        self.hash ^= ZOBRIST_PIECE_KEYS[(piece.team, type(piece))][square]
+        self.opening_score += OPENING_SCORES[(piece.team, type(piece))][square]
+        self.endgame_score += ENDGAME_SCORES[(piece.team, type(piece))][square]
+        self.game_phase += GAME_PHASE_WEIGHTS[type(piece)]
+        if type(piece) is King:
+            self.king_positions[piece.team] = coordinates
+
+    def remove_from_bitboards(self, space, coordinates):
+        """
+        Input: object on a space (either a str or Piece), tuple containing two ints\n
+        Clears the bit of the space in the bitboards, if there is a piece on it
+        """
+        if isinstance(space, Piece):
+            square = coords_to_square(coordinates)
+            bit = 1 << square
+            self.bitboards[(space.team, type(space))] &= ~bit
+            del self.piece_lists[(space.team, type(space))][coordinates]
+            self.occupied[space.team] &= ~bit
+            self.squares[square] = 0
+            self.hash ^= ZOBRIST_PIECE_KEYS[(space.team, type(space))][square]
+            self.opening_score -= OPENING_SCORES[(space.team, type(space))][square]
+            self.endgame_score -= ENDGAME_SCORES[(space.team, type(space))][square]
+            self.game_phase -= GAME_PHASE_WEIGHTS[type(space)]
+            if type(space) is King and self.king_positions[space.team] == coordinates:
+                self.king_positions[space.team] = None
+
+    def set_turn(self, team):
+        """
+        Input: str == either 'black' or 'white'\n
+        Makes it the team's turn
+        """
+        if team != self.turn:
+            self.turn = team
+            self.hash ^= ZOBRIST_BLACK_TO_MOVE
+
+    def record_position(self):
+        """
+        Adds the current position to the game's history
+        """
+        self.position_history.append(self.hash)
+        self.position_counts[self.hash] += 1
+
+    def repetition_count(self):
+        """
+        Output: int - how many times the current position is in the game's history
+        """
+        return self.position_counts[self.hash]
+
+    def record_move(self, selected_position, destination_position):
+        """
+        Inputs: coordinates, coordinates\n
+        Adds a move that is about to be played in the game to the move history
+        """
+        if not self.move_history:
+            self.start_fen = self.to_fen()
+        self.move_history.append((selected_position, destination_position, None))
+
+    def record_promotion(self, piece_type):
+        """
+        Input: Piece class\n
+        Notes in the move history what the pawn that just moved became
+        """
+        if self.move_history:
+            selected_position, destination_position, _ = self.move_history[-1]
+            self.move_history[-1] = (selected_position, destination_position, piece_type)
+
+    def count_move(self, team, pawn_moved_or_captured):
+        """
+        Inputs: str == either 'black' or 'white' - the team that just moved, Boolean\n
+        Advances the FEN move counters after a move in the game
+        """
+        if pawn_moved_or_captured:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if team == 'black':
+            self.fullmove_number += 1
+        self.en_passant = '-'
+
+    def load_fen(self, fen):
+        """
+        Input: str - a FEN (i.e. '4k3/8/8/8/8/8/4P3/4K3 w - - 0 1'). Missing fields after the piece placement get their
+               usual defaults\n
+        Sets the board up from the FEN. The first rank listed is row 0. Raises ValueError if the FEN can not be read,
+        has a pawn on the first or last rank, does not have exactly one king per team or leaves the side not to move in check
+        """
+        fields = fen.split()
+        if not fields or len(fields) > 6:
+            raise ValueError(f"FEN needs 1 to 6 fields: {fen!r}")
+        fields += ['w', '-', '-', '0', '1'][len(fields) - 1:]
+        placement, side, castling_rights, en_passant, halfmove_clock, fullmove_number = fields
+
+        ranks = placement.split('/')
+        if len(ranks) != 8:
+            raise ValueError(f"FEN piece placement needs 8 ranks: {placement!r}")
+        for rank in ranks:
+            if sum(int(letter) if letter.isdigit() else 1 for letter in rank) != 8 or \
+                    any(not letter.isdigit() and letter.lower() not in FEN_PIECES for letter in rank):
+                raise ValueError(f"bad FEN rank: {rank!r}")
+        if side not in FEN_SIDES:
+            raise ValueError(f"FEN side to move must be 'w' or 'b': {side!r}")
+        if castling_rights != '-' and (not set(castling_rights) <= set('KQkq') or
+                                       len(set(castling_rights)) != len(castling_rights)):
+            raise ValueError(f"bad FEN castling rights: {castling_rights!r}")
+        if en_passant != '-' and (len(en_passant) != 2 or en_passant[0] not in 'abcdefgh' or en_passant[1] not in '36'):
+            raise ValueError(f"bad FEN en passant space: {en_passant!r}")
+        if not halfmove_clock.isdigit() or not fullmove_number.isdigit() or int(fullmove_number) < 1:
+            raise ValueError(f"bad FEN move counters: {halfmove_clock!r} {fullmove_number!r}")
+        if any(letter in 'Pp' for letter in ranks[0] + ranks[7]):
+            raise ValueError(f"FEN has a pawn on the first or last rank: {placement!r}")
+        if placement.count('K') != 1 or placement.count('k') != 1:
+            raise ValueError(f"FEN needs exactly one king per team: {placement!r}")
+
+        load_piece_placement(self, placement)
+        self.set_turn(FEN_SIDES[side])
+        row, column = self.king_positions[other_team(self.turn)]
+        if self.is_square_attacked(row * 8 + column, self.turn):
+            raise ValueError(f"FEN has the side not to move in check: {fen!r}")
+        self.castling_rights = castling_rights
+        self.en_passant = en_passant
+        self.halfmove_clock = int(halfmove_clock)
+        self.fullmove_number = int(fullmove_number)
+
+    def to_fen(self):
+        """
+        Output: str - FEN of the position (the first rank written is row 0)
+        """
+        ranks = []
+        for row in self.positions:
+            rank = ''
+            empty_spaces = 0
+            for space in row:
+                if isinstance(space, Piece):
+                    if empty_spaces:
+                        rank += str(empty_spaces)
+                        empty_spaces = 0
+                    letter = FEN_LETTERS[type(space)]
+                    rank += letter.upper() if space.team == 'white' else letter
+                else:
+                    empty_spaces += 1
+            if empty_spaces:
+                rank += str(empty_spaces)
+            ranks.append(rank)
+
+        side = 'w' if self.turn == 'white' else 'b'
+        return f"{'/'.join(ranks)} {side} {self.castling_rights} {self.en_passant} {self.halfmove_clock} {self.fullmove_number}"
+
+    def encode(self, buffer=None, offset=0):
+        """
+        Inputs: optional writable buffer (i.e. bytearray or mmap), optional int - where in the buffer to write\n
+        Output: bytes of length POSITION_SIZE, or None when written into the buffer\n
+        Packs the position: one nibble per space (the codes in Board.squares, the even space in the high nibble),
+        then flags (black to move and castling rights), the en passant column + 1 (0 for none) and the two move counters
+        """
+        squares = self.squares
+        packed_squares = bytes([squares[square] << 4 | squares[square + 1] for square in range(0, 64, 2)])
+
+        flags = 0
+        if self.turn == 'black':
+            flags |= 1
+        for bit, letter in enumerate('KQkq'):
+            if letter in self.castling_rights:
+                flags |= 2 << bit
+        en_passant = 0
+        if self.en_passant != '-':
+            en_passant = 'abcdefgh'.index(self.en_passant[0]) + 1
+
+        state = (packed_squares, flags, en_passant, min(self.halfmove_clock, 255), min(self.fullmove_number, 65535))
+        if buffer is None:
+            return POSITION_STRUCT.pack(*state)
+        POSITION_STRUCT.pack_into(buffer, offset, *state)
+
+    def decode(self, buffer, offset=0):
+        """
+        Inputs: buffer (bytes, bytearray, memoryview or mmap) holding a position from encode(), optional int - where it starts\n
+        Sets the board up from the packed position. The buffer is read in place, nothing is copied out of it first
+        """
+        view = memoryview(buffer)
+        if len(view) - offset < POSITION_SIZE:
+            raise ValueError(f"packed position needs {POSITION_SIZE} bytes")
+        flags, en_passant, halfmove_clock, fullmove_number = POSITION_STRUCT.unpack_from(view, offset)[1:]
+
+        for x in range(len(self.positions)):
+            for y in range(len(self.positions)):
+                self.clear((x, y))
+
+        for index in range(32):
+            byte = view[offset + index]
+            for square, code in ((index * 2, byte >> 4), (index * 2 + 1, byte & 15)):
+                if not code:
+                    continue
+                piece_type = CODE_TYPES[code]
+                if piece_type is None:
+                    raise ValueError(f"bad piece code {code} in packed position")
+                team = 'black' if code & 8 else 'white'
+                piece = piece_type(team, SQUARE_COORDS[square])
+                if piece_type is Pawn:
+                    piece.has_moved = square // 8 != PAWN_STARTING_ROWS[team]
+                self.update(piece)
+
+        self.position_history = []
+        self.position_counts = Counter()
+        self.move_history = []
+        self.set_turn('black' if flags & 1 else 'white')
+        self.castling_rights = ''.join(letter for bit, letter in enumerate('KQkq') if flags & 2 << bit) or '-'
+        self.en_passant = '-'
+        if en_passant:
+            self.en_passant = 'abcdefgh'[en_passant - 1] + ('3' if flags & 1 else '6')
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+
+    def occupied_spaces(self):
+        """
+        Output: bitboard of every occupied space
+        """
+        return self.occupied['white'] | self.occupied['black']
+
+    def pieces_of_type(self, team, *piece_types):
+        """
+        Input: str == either 'black' or 'white', one or more Piece classes\n
+        Output: bitboard of the spaces holding those pieces
+        """
+        bitboard = 0
+        for piece_type in piece_types:
+            bitboard |= self.bitboards[(team, piece_type)]
+        return bitboard
+
+    def spaces_attacked_by_team(self, team, occupied=None):
+        """
+        Input: str == either 'black' or 'white', optional bitboard to use as the occupied spaces\n
+        Output: bitboard of every space the team threatens\n
+        Passing a different occupancy lets callers ask what would be threatened with a piece removed
+        """
+        if occupied is None:
+            occupied = self.occupied_spaces()
+
+        attacks = 0
+        for square in bitboard_to_squares(self.bitboards[(team, Pawn)]):
+            attacks |= PAWN_ATTACKS[team][square]
+        for square in bitboard_to_squares(self.bitboards[(team, Knight)]):
+            attacks |= KNIGHT_ATTACKS[square]
+        for square in bitboard_to_squares(self.bitboards[(team, King)]):
+            attacks |= KING_ATTACKS[square]
+        for square in bitboard_to_squares(self.pieces_of_type(team, Rook, Queen)):
+            attacks |= sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS)
+        for square in bitboard_to_squares(self.pieces_of_type(team, Bishop, Queen)):
+            attacks |= sliding_attacks(square, occupied, DIAGONAL_DIRECTIONS)
+
+        return attacks
     
+    def is_square_attacked(self, square, by_team, occupied=None):
+        """
+        Inputs: int square (row * 8 + column), str == either 'black' or 'white', optional bitboard to use as the occupied spaces\n
+        Output: Boolean - True if any of the team's pieces threatens the space\n
+        Looks outward from the space instead of working out everything the team threatens: a knight's jump away,
+        a pawn's diagonal, a king's step and the first piece along each straight and diagonal line
+        """
+        if KNIGHT_ATTACKS[square] & self.bitboards[(by_team, Knight)]:
+            return True
+        # A pawn threatens the space if a pawn of the other team on the space would threaten the pawn
+        if PAWN_ATTACKS[other_team(by_team)][square] & self.bitboards[(by_team, Pawn)]:
+            return True
+        if KING_ATTACKS[square] & self.bitboards[(by_team, King)]:
+            return True
+
+        if occupied is None:
+            occupied = self.occupied_spaces()
+        rooks_and_queens = self.pieces_of_type(by_team, Rook, Queen)
+        if rooks_and_queens and sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS) & rooks_and_queens:
+            return True
+        bishops_and_queens = self.pieces_of_type(by_team, Bishop, Queen)
+        if bishops_and_queens and sliding_attacks(square, occupied, DIAGONAL_DIRECTIONS) & bishops_and_queens:
+            return True
+        return False
+
+    def has_any_legal_move(self, team):
+        """
+        Input: str == either 'black' or 'white'\n
+        Output: Boolean - True if the team can make a move\n
+        Stops at the first legal move instead of working out all of them, trying first the pieces whose moves are cheap to find
+        and most likely legal: out of check every move of a piece that is not pinned is legal, in check the king's own moves
+        are the likeliest way out. Uses the legal moves in the move cache if the position is already there
+        """
+        key = (self.hash, team)
+        if key in self.move_cache:
+            return any(self.move_cache[key].values())
+
+        pins_and_checks = find_pins_and_checks(self, team)
+        if pins_and_checks is None:
+            piece_order = HAS_ANY_MOVE_ORDER
+            pinned_pieces = {}
+        else:
+            pinned_pieces = pins_and_checks[3]
+            piece_order = HAS_ANY_MOVE_ORDER_IN_CHECK if pins_and_checks[1] else HAS_ANY_MOVE_ORDER
+
+        # Pinned pieces can hardly move, so they are left for last
+        pinned = []
+        for piece in self.piece_list_of_types(team, *piece_order):
+            if piece.position in pinned_pieces:
+                pinned.append(piece)
+                continue
+            for _ in piece.iter_possible_moves(pins_and_checks):
+                return True
+        for piece in pinned:
+            for _ in piece.iter_possible_moves(pins_and_checks):
+                return True
+        return False
+
+    def classify_position(self, team):
+        """
+        Input: str == either 'black' or 'white' - the team to move\n
+        Output: dict - 'check' (Boolean), 'checkers' (list of the enemy pieces checking the king), 'legal_moves' (the output
+                of legal_moves_by_piece()), 'checkmate', 'stalemate' and 'insufficient_material' (Booleans)\n
+        Everything the start of a turn needs to know, from one look at the pins and checks and one pass over the moves.
+        The legal moves go in the move cache, so checking the move that is then played does not work them out again
+        """
+        pins_and_checks = find_pins_and_checks(self, team)
+        checkers = pins_and_checks[1] if pins_and_checks else []
+        legal_moves = legal_moves_by_piece(self, team, pins_and_checks)
+        has_moves = any(legal_moves.values())
+        return {
+            'check': bool(checkers),
+            'checkers': checkers,
+            'legal_moves': legal_moves,
+            'checkmate': bool(checkers) and not has_moves,
+            'stalemate': not checkers and not has_moves,
+            'insufficient_material': self.insufficient_material(),
+        }
+
+    def insufficient_material(self):
+        """
+        Output: Boolean - True if neither team has the pieces left to checkmate with: nothing but the kings and one
+                knight or bishop, or a bishop each on spaces of the same color
+        """
+        for team in ('white', 'black'):
+            if self.pieces_of_type(team, Pawn, Rook, Queen):
+                return False
+        white_minors = self.pieces_of_type('white', Knight, Bishop)
+        black_minors = self.pieces_of_type('black', Knight, Bishop)
+        if count_bits(white_minors | black_minors) <= 1:
+            return True
+        if self.pieces_of_type('white', Knight) or self.pieces_of_type('black', Knight):
+            return False
+        if count_bits(white_minors) != 1 or count_bits(black_minors) != 1:
+            return False
+        # Bishops that stay on the same color of space can never checkmate
+        return bool(white_minors & LIGHT_SPACES) == bool(black_minors & LIGHT_SPACES)
+
     def display(self):
         """
         Prints the board and all the pieces/spaces in it for the user to see
         """
         print('')
-        print("   ---------------------------------")
+        print(self.to_text())
+        print('')
+
+    def to_text(self, colors=True):
+        """
+        Input: optional Boolean - False leaves out the terminal colors (i.e. for the game server)\n
+        Output: string - the board the way display() shows it
+        """
+        lines = ["   ---------------------------------"]
         counter = 0
         for row in self.positions:
             counter += 1
@@ -75,49 +538,75 @@ class Board():
                 else:
                     starter = ' '
                     ender = '|'
-                    if space.team == 'white':
+                    if not colors:
+                        piece = space.symbol+' '
+                    elif space.team == 'white':
                         piece = stylize(space.symbol+' ', colored.fg("light_blue"))
                     else:
                         piece = stylize(space.symbol+' ', colored.fg("light_red"))
                     line += starter+piece+ender
-            print(line)
-            print("   ---------------------------------")
-        print("   | A | B | C | D | E | F | G | H |\n")
-    
-    def update_all_spaces_threatened(self):
+            lines.append(line)
+            lines.append("   ---------------------------------")
+        lines.append("   | A | B | C | D | E | F | G | H |")
+        return '\n'.join(lines)
+
+    def make_move(self, selected_position, destination_position, promotion=None):
         """
-        Loops through all the pieces on the board and makes them update
-        their spaces threatened
+        Inputs: coordinates, coordinates, optional Piece class a pawn becomes on the other side\n
+        Output: tuple with everything unmake_move() needs to take the move back\n
+        Moves a piece without checking if the move is legal
         """
-        spaces_threatened = []
-        for row in self.positions:
-            for space in row:
-                if isinstance(space, Piece):
-                    selected_piece = space
-                    selected_piece.update_spaces_threatened()
-        
-        return spaces_threatened
+        piece = self.coords_to_piece(selected_position)
+        captured_piece = self.coords_to_piece(destination_position)
+        had_moved = piece.has_moved
+
+        self.clear(selected_position)
+        piece.position = destination_position
+        piece.has_moved = True
+        if promotion:
+            moved_piece = promotion(piece.team, destination_position)
+            moved_piece.has_moved = True
+        else:
+            moved_piece = piece
+        self.update(moved_piece)
+        self.set_turn(other_team(piece.team))
 
-    def spaces_threatened_by_team(self, team):
+        return piece, selected_position, destination_position, captured_piece, had_moved
+
+    def make_move_code(self, code):
         """
-        Input: str == either 'black' or 'white'\n
-        Output: list of coordinates
-        """
-        spaces_threatened = []
-        pieces = self.all_pieces_on_team(team)
-        for piece in pieces:
-            if piece.team == team:
-                for threat in piece.spaces_threatened:
-                    spaces_threatened.append(threat)
-        
-        return spaces_threatened
+        Input: int move from encode_move()\n
+        Output: tuple for unmake_move()\n
+        make_move() for the packed moves used by the search
+        """
+        promotion = None
+        if code >> 12:
+            promotion = PROMOTION_CHOICES[(code >> 12) - 1]
+        return self.make_move(SQUARE_COORDS[code & 63], SQUARE_COORDS[code >> 6 & 63], promotion)
+
+    def unmake_move(self, undo):
+        """
+        Input: output of make_move()\n
+        Puts the board back the way it was before the move
+        """
+        piece, selected_position, destination_position, captured_piece, had_moved = undo
 
-THE_BOARD = Board()
+        if isinstance(captured_piece, Piece):
+            self.update(captured_piece)
+        else:
+            self.clear(destination_position)
+        piece.position = selected_position
+        piece.has_moved = had_moved
+        self.update(piece)
+        self.set_turn(piece.team)
 
 
 class Piece():
     "Parent class for all chess piece types"
 
+    # Fixed attributes instead of a __dict__ keep every piece small
+    __slots__ = ('position', 'team', 'has_moved', 'board', 'symbol')
+
     def __init__(self, team, position):
         # Current coordinates
         self.position = position
@@ -128,19 +617,31 @@ class Piece():
         # Keeps track of if the piece has moved or not (for pawn or for castleing)
         self.has_moved = False
 
-        # List of the spaces that the piece is currently threatening (for checks/checkmates/stalemates)
-        self.spaces_threatened = []
+        # Board that the piece was placed on (set by Board.update)
+        self.board = None
 
-        # Keeps track if this piece is currently threatening the enemy king.
-        self.threatening_king = False
+    def moves_ignoring_checks(self):
+        """
+        Output: list of the spaces the piece could move to if its king did not have to be kept out of check\n
+        Every space it threatens that is not held by an ally. Pawns, which do not move where they threaten, have their own
+        """
+        return convert_threats_to_possible_moves(self, self.all_possible_moves(return_spaces_threatened=True))
 
-        # Keeps track of positions that this piece can move to while it's king is in check.
-        self.possible_moves_during_check = []
+    def iter_possible_moves(self, pins_and_checks=False):
+        """
+        Input: optional output of find_pins_and_checks() for the piece's team, worked out here if not given\n
+        Output: generator of the spaces the piece can move to\n
+        Lazy version of all_possible_moves(): each move is only checked against the king's safety once it is asked for,
+        so a caller that stops at the first move never checks the rest
+        """
+        return iter_moves_without_checks(self, self.moves_ignoring_checks(), pins_and_checks)
 
 
 class Pawn(Piece):
     "Class that represents the pawn"
 
+    __slots__ = ('direction',)
+
     def __init__(self, team, position):
         Piece.__init__(self, team, position)
     
@@ -171,26 +672,47 @@ class Pawn(Piece):
 
         # check the two corner spaces and see if there are enemy pieces on them
         # if there are enemy pieces, append the position to occupied_corners
+        enemy_spaces = self.board.occupied[other_team(self.team)]
+
         if is_within_bounds(corner1):
-            if not isinstance(THE_BOARD.positions[corner1[0]][corner1[1]], str):
-                if THE_BOARD.positions[corner1[0]][corner1[1]].team != self.team:
-                    occupied_corners.append(corner1)
+            if enemy_spaces >> coords_to_square(corner1) & 1:
+                occupied_corners.append(corner1)
         
         if is_within_bounds(corner2):
-            if not isinstance(THE_BOARD.positions[corner2[0]][corner2[1]], str):
-                if THE_BOARD.positions[corner2[0]][corner2[1]].team != self.team:
-                    occupied_corners.append(corner2)
+            if enemy_spaces >> coords_to_square(corner2) & 1:
+                occupied_corners.append(corner2)
         
         return occupied_corners
 
-    def all_possible_moves(self):
+    def all_possible_moves(self, return_spaces_threatened=False):
         """
-        Output: list containing all possible pawn movement options (list of tuples)
+        Inputs: 1 Optional Boolean which affects the output\n
+        Output:
+                If all inputs == False; list containing all possible pawn movement options (list of tuples),
+                if return_spaces_threatened; a list of the two forward corners this pawn threatens
 
         Pawn can move forward (down or up based on which team it is on) and capture enemy pieces
         if they are in either adjacent diagonal space in front of the pawn. Cannot move forward
         if blocked by any piece and cannot capture pieces on the same team. 
         """
+        # The threatened spaces will always be it's corners
+        if return_spaces_threatened:
+            row = self.position[0]
+            column = self.position[1]
+            corner1 = (row + 1 * self.direction, column - 1)
+            corner2 = (row + 1 * self.direction, column + 1)
+            return [corner1, corner2]
+
+        # Get rid of all movement options that leave the king in check
+        possible_moves = remove_checks_from_possible_moves(self, self.moves_ignoring_checks())
+    
+        return possible_moves
+
+    def moves_ignoring_checks(self):
+        """
+        Output: list of the spaces the pawn could move to if its king did not have to be kept out of check\n
+        Forward if nothing is in the way (two spaces on its first move) and onto the corners holding an enemy
+        """
         possible_moves = []
 
         # Track current position in the form of row, column
@@ -199,10 +721,10 @@ class Pawn(Piece):
 
         # If the space directly in front of the pawn is blocked, it cannot move forward at all
         # Otherwise, add moving forward 1 space and moving forward 2 spaces to list of possible moves
-        if not is_space_occupied((row + 1 * self.direction, column)):
+        if not is_space_occupied(self.board, (row + 1 * self.direction, column)):
             possible_moves.append((row + 1 * self.direction, column))
             if not self.has_moved:
-                if not is_space_occupied((row + 2 * self.direction, column)):
+                if not is_space_occupied(self.board, (row + 2 * self.direction, column)):
                     possible_moves.append((row + 2 * self.direction, column))
 
         # Add corner movement options if there are any (adjacent diagonal spaces containing an enemy)
@@ -210,69 +732,54 @@ class Pawn(Piece):
         for move in occupied_corners:
             possible_moves.append(move)
 
-        # Get rid of all movement options that take the piece off the board or leave the king in check
-        possible_moves = [move for move in possible_moves if is_within_bounds(move)]
-        possible_moves = remove_checks_from_possible_moves(self, possible_moves)
+        # Get rid of all movement options that take the piece off the board
+        return [move for move in possible_moves if is_within_bounds(move)]
     
-        return possible_moves
-    
-    def check_evolve(self):
+    def check_evolve(self, evolution=None):
         """
+        Input: optional str - what the pawn becomes, the player is asked if not given\n
         Check if conditions are met to 'evolve'. If they are, perform the evolution
         """
         if self.team == 'white':
             if self.position[0] == 0:
-                self.evolve()
+                self.evolve(evolution)
         
         else:
             if self.position[0] == 7:
-                self.evolve()
+                self.evolve(evolution)
     
-    def evolve(self):
+    def evolve(self, evolution=None):
         """
-        Takes a user input and changes the pawn so that it becomes what the user chose
+        Input: optional str == "knight", "bishop", "rook" or "queen"\n
+        Changes the pawn so that it becomes what was chosen. Without a choice the user is asked.
+        Raises ValueError if the choice is not something a pawn can become, the pawn is left as it is
         """
         possible_evolutions = ["knight", "bishop", "rook", "queen"]
-        evolution = input("Choose what your pawn will become: knight, bishop, rook, queen\n")
+        if evolution is None:
+            evolution = input("Choose what your pawn will become: knight, bishop, rook, queen\n")
         if evolution == possible_evolutions[0]:
             evolution_piece = Knight(self.team, self.position)
-            evolution_piece.update_spaces_threatened()
         elif evolution == possible_evolutions[1]:
             evolution_piece = Bishop(self.team, self.position)
-            evolution_piece.update_spaces_threatened()
         elif evolution == possible_evolutions[2]:
             evolution_piece = Rook(self.team, self.position)
-            evolution_piece.update_spaces_threatened()
         elif evolution == possible_evolutions[3]:
             evolution_piece = Queen(self.team, self.position)
-            evolution_piece.update_spaces_threatened()
 
-        # If evolution is not one of those choices, rerun the evolution input
+        # If evolution is not one of those choices, it is up to the caller to ask again or report it
         else:
-            self.evolve()
+            raise ValueError(f"a pawn can become a knight, bishop, rook or queen, not {evolution!r}")
         
         if evolution_piece:
-            THE_BOARD.update(evolution_piece)
-            THE_BOARD.update_all_spaces_threatened()
-    
-    def update_spaces_threatened(self):
-        """
-        Based on the piece's current position, update what spaces this piece threatens.
-        In the instance of the pawn, the spaces threatened are always its forward facing corners
-        """
-        # The threatened spaces will always be it's corners
-        current_row = self.position[0]
-        current_column = self.position[1]
-        corner1 = (current_row + 1 * self.direction, current_column - 1)
-        corner2 = (current_row + 1 * self.direction, current_column + 1)
-        current_spaces_threatened = [corner1, corner2]
-        self.spaces_threatened = current_spaces_threatened
-        update_threatening_king(self)
+            self.board.update(evolution_piece)
+            self.board.record_promotion(type(evolution_piece))
 
 
 class Rook(Piece):
     "Class that represents the rook"
 
+    __slots__ = ()
+
     def __init__(self, team, position):
         Piece.__init__(self, team, position)
     
@@ -314,35 +821,13 @@ class Rook(Piece):
         possible_moves = remove_checks_from_possible_moves(self, possible_moves)
         
         return possible_moves
-    
-    def update_spaces_threatened(self):
-        """
-        Based on the piece's current position, update what spaces this piece threatens.\n
-        In the instance of the rook, the spaces threatened are always along the row+column it occupies,
-        including the space that a piece that is blocking the rest of the path occupies, regardless of team
-        """
-        # Spaces threatened are all the spaces it can move to + guarding an ally at the end of a path
-        self.spaces_threatened = self.all_possible_moves(return_spaces_threatened=True)
-        update_threatening_king(self)
-    
-    def spaces_threatened_towards_king(self, list_of_directional_spaces_threatened):
-        """
-        ONLY CALL THIS FUNCTION IF YOU KNOW THE PIECE IS THREATENING THE KING\n
-        Input: list of list of spaces. Each list is seperated by direction\n
-        This function scans through every space provided. If the king is found,
-        the directional list containing the space is returned
-        """
-        for lst in list_of_directional_spaces_threatened:
-            for move in lst:
-                if isinstance(THE_BOARD.coords_to_piece(move), King):
-                    return(lst)
-        
-        raise Exception(f"{self.symbol} not threatening the enemy king")
 
 
 class Knight(Piece):
     "Class that represents the knight"
 
+    __slots__ = ()
+
     def __init__(self, team, position):
         Piece.__init__(self, team, position)
     
@@ -361,39 +846,21 @@ class Knight(Piece):
         The knight can move to any space that is (current row +-2, current column +-1) and (current row +-1, current column +-2),
         as long as there is not a piece on the space that is on the same team as the knight
         """
-        row = self.position[0]
-        column = self.position[1]
-
-        threat1 = (row+2, column+1)
-        threat2 = (row+2, column-1)
-        threat3 = (row-2, column+1)
-        threat4 = (row-2, column-1)
-        threat5 = (row+1, column+2)
-        threat6 = (row+1, column-2)
-        threat7 = (row-1, column+2)
-        threat8 = (row-1, column-2)
-
-        threatened_spaces = [threat1, threat2, threat3, threat4, threat5, threat6, threat7, threat8]
-        threatened_spaces = [move for move in threatened_spaces if is_within_bounds(move)]
+        # The jumps that stay on the board are precomputed for every space
+        threatened_spaces = bitboard_to_coords(KNIGHT_ATTACKS[coords_to_square(self.position)])
         if return_spaces_threatened:
             return threatened_spaces
             
         possible_moves = convert_threats_to_possible_moves(self, threatened_spaces)
         possible_moves = remove_checks_from_possible_moves(self, possible_moves)
         return possible_moves
-    
-    def update_spaces_threatened(self):
-        """
-        Based on the piece's current position, update what spaces this piece threatens.\n
-        In the instance of the knight, it is everywhere it can move to, regardless of the piece that is in the destination
-        """
-        self.spaces_threatened = self.all_possible_moves(return_spaces_threatened=True)
-        update_threatening_king(self)
 
 
 class Bishop(Piece):
     "Class that represents the bishop"
 
+    __slots__ = ()
+
     def __init__(self, team, position):
         Piece.__init__(self, team, position)
     
@@ -431,35 +898,13 @@ class Bishop(Piece):
         possible_moves = convert_threats_to_possible_moves(self, threatened_spaces)
         possible_moves = remove_checks_from_possible_moves(self, possible_moves)
         return possible_moves
-    
-    def update_spaces_threatened(self):
-        """
-        Based on the piece's current position, update what spaces this piece threatens.\n
-        In the instance of the bishop, the spaces threatened are always along the diagonal paths from its position,
-        including the space that a piece that is blocking the rest of the path occupies, regardless of team
-        """
-        # Spaces threatened are all the spaces it can move to + guarding an ally at the end of a path
-        self.spaces_threatened = self.all_possible_moves(return_spaces_threatened=True)
-        update_threatening_king(self)
-    
-    def spaces_threatened_towards_king(self, list_of_directional_spaces_threatened):
-        """
-        ONLY CALL THIS FUNCTION IF YOU KNOW THE PIECE IS THREATENING THE KING\n
-        Input: list of list of spaces. Each list is seperated by direction\n
-        This function scans through every space provided. If the king is found,
-        the directional list containing the space is returned
-        """
-        for lst in list_of_directional_spaces_threatened:
-            for move in lst:
-                if isinstance(THE_BOARD.coords_to_piece(move), King):
-                    return(lst)
-        
-        raise Exception(f"{self.symbol} not threatening the enemy king")
 
 
 class Queen(Piece):
     "Class that represents the queen"
 
+    __slots__ = ()
+
     def __init__(self, team, position):
         Piece.__init__(self, team, position)
     
@@ -502,36 +947,13 @@ class Queen(Piece):
         possible_moves = convert_threats_to_possible_moves(self, threatened_spaces)
         possible_moves = remove_checks_from_possible_moves(self, possible_moves)
         return possible_moves
-    
-    def update_spaces_threatened(self):
-        """
-        Based on the piece's current position, update what spaces this piece threatens.\n
-        In the instance of the queen, the spaces threatened are always along the row+column it from its position,
-        and the diagonals from its position, including the space that a piece that is blocking the rest of the path occupies,
-        regardless of team
-        """
-        # Spaces threatened are all the spaces it can move to + guarding an ally at the end of a path
-        self.spaces_threatened = self.all_possible_moves(return_spaces_threatened=True)
-        update_threatening_king(self)
-    
-    def spaces_threatened_towards_king(self, list_of_directional_spaces_threatened):
-        """
-        ONLY CALL THIS FUNCTION IF YOU KNOW THE PIECE IS THREATENING THE KING\n
-        Input: list of list of spaces. Each list is seperated by direction\n
-        This function scans through every space provided. If the king is found,
-        the directional list containing the space is returned
-        """
-        for lst in list_of_directional_spaces_threatened:
-            for move in lst:
-                if isinstance(THE_BOARD.coords_to_piece(move), King):
-                    return(lst)
-        
-        raise Exception(f"{self.symbol} not threatening the enemy king")
 
 
 class King(Piece):
     "Class that represents the king"
 
+    __slots__ = ()
+
     def __init__(self, team, position):
         Piece.__init__(self, team, position)
     
@@ -550,50 +972,31 @@ class King(Piece):
         The king can move to any adjacent space, for a maximum total of 8 possible moves. If one of those
         spaces is occupied, the king can move there if the occupant is from the enemy team
         """
-        threatened_spaces = []
-        current_row = self.position[0]
-        current_column = self.position[1]
-
-        threatened_spaces.append((current_row+1, current_column))
-        threatened_spaces.append((current_row-1, current_column))
-        threatened_spaces.append((current_row, current_column+1))
-        threatened_spaces.append((current_row, current_column-1))
-        threatened_spaces.append((current_row-1, current_column-1))
-        threatened_spaces.append((current_row-1, current_column+1))
-        threatened_spaces.append((current_row+1, current_column-1))
-        threatened_spaces.append((current_row+1, current_column+1))
-
-        threatened_spaces = [move for move in threatened_spaces if is_within_bounds(move)]
+        # The adjacent spaces that stay on the board are precomputed for every space
+        threatened_spaces = bitboard_to_coords(KING_ATTACKS[coords_to_square(self.position)])
         if return_spaces_threatened:
             return threatened_spaces
 
         possible_moves = convert_threats_to_possible_moves(self, threatened_spaces)
         possible_moves = remove_checks_from_possible_moves(self, possible_moves)
         return possible_moves
-    
-    def update_spaces_threatened(self):
-        """
-        Based on the piece's current position, update what spaces this piece threatens.\n
-        In the instance of the king, the spaces threatened are all its adjacent spaces, regardless of what lies in those spaces
-        """
-        self.spaces_threatened = self.all_possible_moves(return_spaces_threatened=True)
-        update_threatening_king(self)
         
 
-def initialize_board():
+def initialize_board(board):
     """
+    Input: Board object\n
     Initializes the chess board with all 32 pieces
     """
     # Wipe current board
-    for x in range(len(THE_BOARD.positions)):
-        for y in range(len(THE_BOARD.positions)):
-            THE_BOARD.positions[x][y] = ' '
+    for x in range(len(board.positions)):
+        for y in range(len(board.positions)):
+            board.clear((x, y))
 
     all_pieces = []
 
     # Pawns
-    white_pawns = [Pawn('white', (6, i)) for i in range(len(THE_BOARD.positions[6]))]
-    black_pawns = [Pawn('black', (1, i)) for i in range(len(THE_BOARD.positions[1]))]
+    white_pawns = [Pawn('white', (6, i)) for i in range(len(board.positions[6]))]
+    black_pawns = [Pawn('black', (1, i)) for i in range(len(board.positions[1]))]
     all_pieces.extend(white_pawns)
     all_pieces.extend(black_pawns)
 
@@ -637,22 +1040,62 @@ def initialize_board():
     king2 = King('white', (7, 3))
     all_pieces.append(king2)
 
-    # Add every single piece to the board. Only then can they update their spaces threatened
+    # Add every single piece to the board
     for piece in all_pieces:
-        THE_BOARD.update(piece)
-    THE_BOARD.update_all_spaces_threatened()
+        board.update(piece)
+
+    # A new game starts with white and no history
+    board.set_turn('white')
+    board.position_history = []
+    board.position_counts = Counter()
+    board.move_history = []
+    board.castling_rights = '-'
+    board.en_passant = '-'
+    board.halfmove_clock = 0
+    board.fullmove_number = 1
+
 
+def load_piece_placement(board, placement):
+    """
+    Inputs: Board object, str - the piece placement part of a FEN (i.e. '4k3/8/8/8/8/8/4P3/4K3')\n
+    Wipes the board and sets it up with the pieces described. The first rank listed is row 0.
+    Pawns that are not on their starting row are marked as having moved
+    """
+    for x in range(len(board.positions)):
+        for y in range(len(board.positions)):
+            board.clear((x, y))
+
+    for row, rank in enumerate(placement.split('/')):
+        column = 0
+        for letter in rank:
+            if letter.isdigit():
+                column += int(letter)
+                continue
+            if letter.isupper():
+                team = 'white'
+            else:
+                team = 'black'
+            piece = FEN_PIECES[letter.lower()](team, (row, column))
+            if isinstance(piece, Pawn):
+                piece.has_moved = row != PAWN_STARTING_ROWS[team]
+            board.update(piece)
+            column += 1
+
+    board.position_history = []
+    board.position_counts = Counter()
+    board.move_history = []
 
-def is_space_occupied(coordinates):
+
+def is_space_occupied(board, coordinates):
     """
-    Input: tuple with two ints. both ints must be within the board i.e. 0 <= int <= 7\n
+    Input: Board object, tuple with two ints. both ints must be within the board i.e. 0 <= int <= 7\n
     Output: Boolean\n
     Given coordinates, checks the board at that position. returns False if empty, True if occupied
     """
-    if isinstance(THE_BOARD.positions[coordinates[0]][coordinates[1]], str):
-        return False
-    else:
+    if board.occupied_spaces() >> coords_to_square(coordinates) & 1:
         return True
+    else:
+        return False
 
 
 def is_within_bounds(coordinates):
@@ -668,75 +1111,148 @@ def is_within_bounds(coordinates):
     return False
 
 
-def check_threats_in_one_straight_direction(selected_piece, row_or_column, direction):
+def coords_to_square(coordinates):
     """
-    Inputs: Piece (Rook or Queen), string ("row" or "column"), int (1 for up or right, -1 for down or left)\n
-    Output: List of coordinates in specified direction\n
-    This function is a helper function for Rook or Queen movement 
+    Input: tuple pair of two ints\n
+    Output: int - the bit number of the space in a bitboard (row * 8 + column)
     """
-    possible_moves = []
-    current_row = selected_piece.position[0]
-    current_column = selected_piece.position[1]
+    return coordinates[0] * 8 + coordinates[1]
 
-    if row_or_column == "column":
-        counter = 0
-        while True:
-            counter += 1
-            move = (current_row, current_column + counter * direction)
-            if is_within_bounds(move):
-                if is_space_occupied(move):
-                    possible_moves.append(move)
-                    break
-                else:
-                    possible_moves.append(move)
 
-            else:
-                break
-                
-    elif row_or_column == "row":
-        counter = 0
-        while True:
+def bitboard_to_squares(bitboard):
+    """
+    Input: int bitboard\n
+    Output: generator of the bit numbers that are set, lowest first
+    """
+    while bitboard:
+        lowest_bit = bitboard & -bitboard
+        yield lowest_bit.bit_length() - 1
+        bitboard ^= lowest_bit
+
+
+def bitboard_to_coords(bitboard):
+    """
+    Input: int bitboard\n
+    Output: list of coordinates of the spaces that are set
+    """
+    return [SQUARE_COORDS[square] for square in bitboard_to_squares(bitboard)]
+
+
+def build_attack_table(jumps):
+    """
+    Input: list of (row, column) offsets\n
+    Output: list of 64 bitboards, the spaces reachable from each space with one of the jumps
+    """
+    table = []
+    for square in range(64):
+        row, column = SQUARE_COORDS[square]
+        bitboard = 0
+        for row_jump, column_jump in jumps:
+            space = (row + row_jump, column + column_jump)
+            if is_within_bounds(space):
+                bitboard |= 1 << coords_to_square(space)
+        table.append(bitboard)
+    return table
+
+
+def build_ray_squares(direction):
+    """
+    Input: (row, column) direction\n
+    Output: list of 64 lists, the squares from each space to the edge of the board in that direction (nearest first)
+    """
+    table = []
+    for square in range(64):
+        row, column = SQUARE_COORDS[square]
+        ray = []
+        counter = 1
+        while is_within_bounds((row + counter * direction[0], column + counter * direction[1])):
+            ray.append(coords_to_square((row + counter * direction[0], column + counter * direction[1])))
             counter += 1
-            move = (current_row + counter * direction, current_column)
-            if is_within_bounds(move):
-                if is_space_occupied(move):
-                    possible_moves.append(move)
-                    break
-                else:
-                    possible_moves.append(move)
+        table.append(ray)
+    return table
+
+
+def nearest_square(bitboard, direction):
+    """
+    Inputs: bitboard of spaces on one ray, (row, column) direction of the ray\n
+    Output: int square of the space closest to the start of the ray\n
+    On rays that go towards higher squares that is the lowest bit, otherwise the highest
+    """
+    if RAY_GOES_UP[direction]:
+        return (bitboard & -bitboard).bit_length() - 1
+    return bitboard.bit_length() - 1
+
+
+def sliding_attacks(square, occupied, directions):
+    """
+    Inputs: int square, bitboard of occupied spaces, list of directions\n
+    Output: bitboard of the spaces a rook/bishop/queen on the square threatens along those directions\n
+    Each ray stops at (and includes) the first occupied space
+    """
+    attacks = 0
+    for direction in directions:
+        ray = RAYS[direction][square]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= RAYS[direction][nearest_square(blockers, direction)]
+        attacks |= ray
+    return attacks
+
+
+# Directions (row, column) a piece can travel along in one step
+STRAIGHT_DIRECTIONS = [(-1, 0), (1, 0), (0, 1), (0, -1)]
+DIAGONAL_DIRECTIONS = [(-1, 1), (-1, -1), (1, -1), (1, 1)]
+KNIGHT_JUMPS = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
+
+# Precomputed tables so attacks are bit operations instead of walking the board
+SQUARE_COORDS = [(square // 8, square % 8) for square in range(64)]
+FULL_BITBOARD = (1 << 64) - 1
+KNIGHT_ATTACKS = build_attack_table(KNIGHT_JUMPS)
+KING_ATTACKS = build_attack_table(STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS)
+PAWN_ATTACKS = {'white': build_attack_table([(-1, -1), (-1, 1)]), 'black': build_attack_table([(1, -1), (1, 1)])}
+RAY_SQUARES = {}
+RAYS = {}
+RAY_GOES_UP = {}
+for ray_direction in STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS:
+    RAY_SQUARES[ray_direction] = build_ray_squares(ray_direction)
+    RAYS[ray_direction] = [sum(1 << ray_square for ray_square in ray) for ray in RAY_SQUARES[ray_direction]]
+    RAY_GOES_UP[ray_direction] = ray_direction[0] * 8 + ray_direction[1] > 0
+
+
+def check_threats_in_one_direction(selected_piece, direction):
+    """
+    Inputs: Piece (Rook, Bishop or Queen), (row, column) direction\n
+    Output: List of coordinates in specified direction, up to and including the first occupied space
+    """
+    possible_moves = []
+    occupied = selected_piece.board.occupied_spaces()
+    for square in RAY_SQUARES[direction][coords_to_square(selected_piece.position)]:
+        possible_moves.append(SQUARE_COORDS[square])
+        if occupied >> square & 1:
+            break
 
-            else:
-                break
-    
     return possible_moves
 
 
+def check_threats_in_one_straight_direction(selected_piece, row_or_column, direction):
+    """
+    Inputs: Piece (Rook or Queen), string ("row" or "column"), int (1 for up or right, -1 for down or left)\n
+    Output: List of coordinates in specified direction\n
+    This function is a helper function for Rook or Queen movement 
+    """
+    if row_or_column == "column":
+        return check_threats_in_one_direction(selected_piece, (0, direction))
+    else:
+        return check_threats_in_one_direction(selected_piece, (direction, 0))
+
+
 def check_threats_in_one_diagonal_direction(selected_piece, up_down_direction, left_right_direction):
     """
     Inputs: Piece (Bishop or Queen), int (-1 or 1. up or down), int (-1 or 1. left or right)\n
     Output: List of coordinates in specified direction\n
     This function is a helper function for Bishop or Queen movement 
     """
-    possible_moves = []
-    current_row = selected_piece.position[0]
-    current_column = selected_piece.position[1]
-
-    counter = 0
-    while True:
-        counter += 1
-        move = (current_row + counter * left_right_direction, current_column + counter * up_down_direction)
-
-        if is_within_bounds(move):
-                if is_space_occupied(move):
-                    possible_moves.append(move)
-                    break
-                else:
-                    possible_moves.append(move)
-        
-        else:
-            break
-    
-    return possible_moves
+    return check_threats_in_one_direction(selected_piece, (left_right_direction, up_down_direction))
 
 
 def convert_threats_to_possible_moves(piece, list_of_threats):
@@ -748,15 +1264,10 @@ def convert_threats_to_possible_moves(piece, list_of_threats):
     """
 
     possible_moves = []
+    allies = piece.board.occupied[piece.team]
 
     for space in list_of_threats:
-        selected_piece = THE_BOARD.coords_to_piece(space)
-        if isinstance(selected_piece, Piece):
-            if selected_piece.team == piece.team:
-                pass
-            else:
-                possible_moves.append(space)
-        else:
+        if not allies >> coords_to_square(space) & 1:
             possible_moves.append(space)
 
     return possible_moves
@@ -768,28 +1279,1590 @@ def remove_checks_from_possible_moves(self, possible_moves):
     Output: Updated list of possible moves
     Helper function each piece's all_possible_moves() function
     """
+    return list(iter_moves_without_checks(self, possible_moves))
+
+
+def iter_moves_without_checks(self, possible_moves, pins_and_checks=False):
+    """
+    Inputs: List of possible moves, optional output of find_pins_and_checks() for the piece's team (worked out here if not given)\n
+    Output: generator of the moves that do not leave the king in check
+    """
+    # Get rid of all movement options that leaves the king in check
+    if pins_and_checks is False:
+        pins_and_checks = find_pins_and_checks(self.board, self.team)
+
+    # Without a king on the board nothing can be left in check
+    if pins_and_checks is None:
+        yield from possible_moves
+        return
+    king, pieces_checking_king, spaces_stopping_check, pinned_pieces = pins_and_checks
+
+    # The king cannot step onto any space the enemy would threaten once the king has left its space
+    if self is king:
+        opposite_team = other_team(king.team)
+        occupied = self.board.occupied_spaces() & ~(1 << coords_to_square(king.position))
+        for move in possible_moves:
+            if not self.board.is_square_attacked(coords_to_square(move), opposite_team, occupied):
+                yield move
+        return
+
+    # In double check only the king can move
+    if len(pieces_checking_king) > 1:
+        return
+
+    # In check, the move has to capture the checking piece or block its path
+    allowed_spaces = FULL_BITBOARD
+    if pieces_checking_king:
+        allowed_spaces &= spaces_stopping_check
+
+    # A pinned piece can only slide along the line between its king and the pinning piece
+    if self.position in pinned_pieces:
+        allowed_spaces &= pinned_pieces[self.position]
+
+    if allowed_spaces == FULL_BITBOARD:
+        yield from possible_moves
+        return
+    for move in possible_moves:
+        if allowed_spaces >> coords_to_square(move) & 1:
+            yield move
+
+
+def simulate_moves_for_checks(piece, possible_moves):
+    """
+    Inputs: Piece object, List of possible moves\n
+    Output: Updated list of possible moves\n
+    Slow version of remove_checks_from_possible_moves() that physically makes every move
+    on the board and asks is_my_king_in_check(). run_movegen_suite() checks the fast version against it
+    """
     # Get rid of all movement options that leaves the king in check
     new_possible_moves = []
-    old_position = self.position
+    old_position = piece.position
 
     for move in possible_moves:
         # Move the piece to the potential destination and see if the king is in check
-        piece_in_destination = THE_BOARD.coords_to_piece(move)
-        self.position = move
-        THE_BOARD.positions[old_position[0]][old_position[1]] = ' '
-        THE_BOARD.update(self)
-        THE_BOARD.update_all_spaces_threatened()
-        if not is_my_king_in_check(self.team):
+        piece_in_destination = piece.board.coords_to_piece(move)
+        piece.position = move
+        piece.board.clear(old_position)
+        piece.board.update(piece)
+        if not is_my_king_in_check(piece.board, piece.team):
             new_possible_moves.append(move)
         # Reset the board state
-        self.position = old_position
-        THE_BOARD.positions[move[0]][move[1]] = piece_in_destination
-        THE_BOARD.update(self)
-        THE_BOARD.update_all_spaces_threatened()
+        piece.position = old_position
+        if isinstance(piece_in_destination, Piece):
+            piece.board.update(piece_in_destination)
+        else:
+            piece.board.clear(move)
+        piece.board.update(piece)
 
     return new_possible_moves
 
 
+def find_pins_and_checks(board, team):
+    """
+    Input: Board object, str == either 'black' or 'white'\n
+    Output: None if the team has no king. Otherwise a tuple containing:
+            the King object,
+            list of enemy pieces checking the king,
+            bitboard of spaces that capture or block a single check,
+            dict of pinned piece positions mapped to a bitboard of the spaces that piece can still move to\n
+    Looks outward from the king once so every piece's moves can be filtered without moving anything
+    """
+    king_bitboard = board.bitboards[(team, King)]
+    if not king_bitboard:
+        return None
+    king_square = king_bitboard.bit_length() - 1
+    king = board.coords_to_piece(SQUARE_COORDS[king_square])
+
+    opposite_team = other_team(team)
+
+    pieces_checking_king = []
+    spaces_stopping_check = 0
+    pinned_pieces = {}
+    allies = board.occupied[team]
+    occupied = board.occupied_spaces()
+
+    # Rooks and queens attack along straight lines, bishops and queens along diagonals
+    straight_attackers = board.pieces_of_type(opposite_team, Rook, Queen)
+    diagonal_attackers = board.pieces_of_type(opposite_team, Bishop, Queen)
+    for directions, attackers in ((STRAIGHT_DIRECTIONS, straight_attackers), (DIAGONAL_DIRECTIONS, diagonal_attackers)):
+        for direction in directions:
+            ray = RAYS[direction][king_square]
+            blockers = ray & occupied
+            if not blockers:
+                continue
+            first_blocker = nearest_square(blockers, direction)
+            if attackers >> first_blocker & 1:
+                pieces_checking_king.append(board.coords_to_piece(SQUARE_COORDS[first_blocker]))
+                spaces_stopping_check |= ray ^ RAYS[direction][first_blocker]
+
+            # The first ally on the path might be pinned, a second piece shields the king completely
+            elif allies >> first_blocker & 1:
+                blockers ^= 1 << first_blocker
+                if blockers:
+                    second_blocker = nearest_square(blockers, direction)
+                    if attackers >> second_blocker & 1:
+                        pinned_pieces[SQUARE_COORDS[first_blocker]] = ray ^ RAYS[direction][second_blocker]
+
+    # Knights and pawns cannot be blocked, the only way to stop them is to capture them
+    # An enemy pawn threatens the king from the same corners a pawn of the king's team would threaten
+    jumpers = KNIGHT_ATTACKS[king_square] & board.bitboards[(opposite_team, Knight)]
+    jumpers |= PAWN_ATTACKS[team][king_square] & board.bitboards[(opposite_team, Pawn)]
+    for square in bitboard_to_squares(jumpers):
+        pieces_checking_king.append(board.coords_to_piece(SQUARE_COORDS[square]))
+        spaces_stopping_check |= 1 << square
+
+    return king, pieces_checking_king, spaces_stopping_check, pinned_pieces
+
+
+def spaces_threatened_without_king(king):
+    """
+    Input: King object\n
+    Output: bitboard of spaces\n
+    Every space the enemy threatens if the king were not on the board. The king cannot hide
+    from a rook/bishop/queen by stepping back along the path it is being attacked on
+    """
+    opposite_team = other_team(king.team)
+
+    occupied = king.board.occupied_spaces() & ~(1 << coords_to_square(king.position))
+    return king.board.spaces_attacked_by_team(opposite_team, occupied)
+
+
+def all_legal_moves(board, team):
+    """
+    Inputs: Board object, str == either 'black' or 'white'\n
+    Output: list of (selected position, destination position, promotion) tuples\n
+    Every legal move for the team. A pawn move onto the far side is listed once for
+    every piece the pawn can become, otherwise promotion is None
+    """
+    moves = []
+    for piece in board.all_pieces_on_team(team):
+        promotes = isinstance(piece, Pawn) and piece.position[0] + piece.direction in (0, 7)
+        for destination in piece.all_possible_moves():
+            if promotes:
+                for evolution in PROMOTION_CHOICES:
+                    moves.append((piece.position, destination, evolution))
+            else:
+                moves.append((piece.position, destination, None))
+    return moves
+
+
+def generate_move_codes(board, team):
+    """
+    Inputs: Board object, str == either 'black' or 'white'\n
+    Output: list of ints from encode_move()\n
+    The same moves as all_legal_moves(), worked out with bitboards and packed into ints
+    so the search and perft never build coordinate tuples or call into the Piece objects
+    """
+    opposite_team = other_team(team)
+    allies = board.occupied[team]
+    enemies = board.occupied[opposite_team]
+    occupied = allies | enemies
+    codes = []
+
+    pins_and_checks = find_pins_and_checks(board, team)
+    allowed_spaces = FULL_BITBOARD
+    pinned_pieces = {}
+    if pins_and_checks is not None:
+        king, pieces_checking_king, spaces_stopping_check, pinned_pieces = pins_and_checks
+        king_square = coords_to_square(king.position)
+        targets = KING_ATTACKS[king_square] & ~allies & ~spaces_threatened_without_king(king)
+        for target in bitboard_to_squares(targets):
+            codes.append(king_square | target << 6)
+
+        # In double check only the king can move
+        if len(pieces_checking_king) > 1:
+            return codes
+        if pieces_checking_king:
+            allowed_spaces = spaces_stopping_check
+
+    def allowed_for(square):
+        if pinned_pieces:
+            return allowed_spaces & pinned_pieces.get(SQUARE_COORDS[square], FULL_BITBOARD)
+        return allowed_spaces
+
+    for square in bitboard_to_squares(board.bitboards[(team, Knight)]):
+        for target in bitboard_to_squares(KNIGHT_ATTACKS[square] & ~allies & allowed_for(square)):
+            codes.append(square | target << 6)
+    for square in bitboard_to_squares(board.pieces_of_type(team, Bishop, Queen)):
+        for target in bitboard_to_squares(sliding_attacks(square, occupied, DIAGONAL_DIRECTIONS) & ~allies & allowed_for(square)):
+            codes.append(square | target << 6)
+    for square in bitboard_to_squares(board.pieces_of_type(team, Rook, Queen)):
+        for target in bitboard_to_squares(sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS) & ~allies & allowed_for(square)):
+            codes.append(square | target << 6)
+
+    step = PAWN_STEPS[team]
+    for square in bitboard_to_squares(board.bitboards[(team, Pawn)]):
+        targets = PAWN_ATTACKS[team][square] & enemies
+        forward = square + step
+        if not occupied >> forward & 1:
+            targets |= 1 << forward
+            if not board.positions[square // 8][square % 8].has_moved:
+                double_forward = forward + step
+                if 0 <= double_forward < 64 and not occupied >> double_forward & 1:
+                    targets |= 1 << double_forward
+        targets &= allowed_for(square)
+        for target in bitboard_to_squares(targets):
+            if target < 8 or target >= 56:
+                for promotion_index in range(1, len(PROMOTION_CHOICES) + 1):
+                    codes.append(square | target << 6 | promotion_index << 12)
+            else:
+                codes.append(square | target << 6)
+
+    return codes
+
+
+def perft(board, team, depth):
+    """
+    Inputs: Board object, str == either 'black' or 'white', int\n
+    Output: int - the number of move sequences (nodes) that are depth moves long\n
+    Walks the whole game tree with make_move()/unmake_move(). The counts are known for a lot of
+    positions, so this checks the move generation and measures how fast it is
+    """
+    moves = generate_move_codes(board, team)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+
+    opposite_team = other_team(team)
+
+    nodes = 0
+    for code in moves:
+        undo = board.make_move_code(code)
+        nodes += perft(board, opposite_team, depth - 1)
+        board.unmake_move(undo)
+    return nodes
+
+
+def perft_divide(board, team, depth):
+    """
+    Inputs: Board object, str == either 'black' or 'white', int\n
+    Output: dict of each first move (selected position, destination position, promotion) to its node count\n
+    Splitting the count by first move narrows a wrong total down to the move that causes it
+    """
+    opposite_team = other_team(team)
+
+    divide = {}
+    for selected_position, destination_position, promotion in all_legal_moves(board, team):
+        undo = board.make_move(selected_position, destination_position, promotion)
+        divide[(selected_position, destination_position, promotion)] = perft(board, opposite_team, depth - 1)
+        board.unmake_move(undo)
+    return divide
+
+
+def run_perft(board, team, depth, show_divide=True):
+    """
+    Inputs: Board object, str == either 'black' or 'white', int, optional Boolean\n
+    Output: int - node count\n
+    Prints the divide breakdown, the total and the nodes per second
+    """
+    start_time = time.perf_counter()
+    divide = perft_divide(board, team, depth)
+    elapsed = time.perf_counter() - start_time
+    nodes = sum(divide.values())
+
+    if show_divide:
+        for (selected_position, destination_position, promotion), count in divide.items():
+            move = coords_to_input(selected_position) + ' to ' + coords_to_input(destination_position)
+            if promotion:
+                move += ' ' + promotion.__name__.lower()
+            print(f'{move}: {count}')
+    print(f'perft({depth}) = {nodes} nodes in {elapsed:.3f}s ({nodes / max(elapsed, 1e-9):.0f} nodes/s)')
+    return nodes
+
+
+def run_perft_suite(max_nodes=None):
+    """
+    Input: optional int - skip expected counts larger than this\n
+    Output: Boolean - True if every count matched\n
+    Runs perft on every position in PERFT_SUITE and reports mismatches
+    """
+    all_passed = True
+    total_nodes = 0
+    start_time = time.perf_counter()
+    board = Board()
+
+    for name, fen, expected_counts in PERFT_SUITE:
+        for depth, expected in expected_counts.items():
+            if max_nodes is not None and expected > max_nodes:
+                continue
+            board.load_fen(fen)
+            team = board.turn
+
+            depth_start_time = time.perf_counter()
+            nodes = perft(board, team, depth)
+            elapsed = time.perf_counter() - depth_start_time
+            total_nodes += nodes
+
+            if nodes == expected:
+                result = 'ok'
+            else:
+                result = f'MISMATCH (expected {expected})'
+                all_passed = False
+            print(f'{name} perft({depth}) = {nodes} {result} [{nodes / max(elapsed, 1e-9):.0f} nodes/s]')
+
+    elapsed = time.perf_counter() - start_time
+    print(f'{total_nodes} nodes in {elapsed:.3f}s ({total_nodes / max(elapsed, 1e-9):.0f} nodes/s)')
+    return all_passed
+
+
+def encoding_mismatch(board, decoded_board):
+    """
+    Inputs: Board object, Board object set up from the first one with encode() and decode()\n
+    Output: str describing the first difference between the two, or None if they are the same
+    """
+    for row in range(8):
+        for column in range(8):
+            space = board.positions[row][column]
+            decoded_space = decoded_board.positions[row][column]
+            if not isinstance(space, Piece) and not isinstance(decoded_space, Piece):
+                continue
+            name = square_name((row, column))
+            if type(space) is not type(decoded_space) or space.team != decoded_space.team:
+                return f'{name} holds {decoded_space!r} instead of {space!r}'
+            if isinstance(space, Pawn) and space.has_moved != decoded_space.has_moved:
+                return f'pawn on {name} has_moved is {decoded_space.has_moved} instead of {space.has_moved}'
+    if board.turn != decoded_board.turn:
+        return f'{decoded_board.turn} to move instead of {board.turn}'
+    if board.hash != decoded_board.hash:
+        return 'hash differs'
+    if board.to_fen() != decoded_board.to_fen():
+        return f'FEN {decoded_board.to_fen()} instead of {board.to_fen()}'
+    return None
+
+
+def run_encoding_suite(game_count=20, max_plies=200, seed=20200531):
+    """
+    Inputs: optional int - random games to play, optional int - longest game, optional int - seed of the random moves\n
+    Output: Boolean - True if every position came back the same\n
+    Packs and unpacks every position in PERFT_SUITE and every position of some random games from the starting board
+    (which move pawns, promote and leave either side to move), and reports any position that does not come back the same
+    """
+    board = Board()
+    decoded_board = Board()
+    rng = random.Random(seed)
+    positions = 0
+    mismatches = 0
+
+    def check(name):
+        nonlocal positions, mismatches
+        decoded_board.decode(board.encode())
+        positions += 1
+        mismatch = encoding_mismatch(board, decoded_board)
+        if mismatch:
+            mismatches += 1
+            print(f'{name}: {mismatch}')
+
+    for name, fen, expected_counts in PERFT_SUITE:
+        board.load_fen(fen)
+        check(name)
+
+    for game in range(game_count):
+        initialize_board(board)
+        for ply in range(max_plies):
+            moves = all_legal_moves(board, board.turn)
+            if not moves:
+                break
+            selected_position, destination_position, promotion = rng.choice(moves)
+            piece = board.coords_to_piece(selected_position)
+            board.count_move(board.turn, isinstance(piece, Pawn) or is_space_occupied(board, destination_position))
+            board.make_move(selected_position, destination_position, promotion)
+            check(f'random game {game + 1} ply {ply + 1} ({board.to_fen()})')
+
+    print(f'{positions} positions packed and unpacked, {mismatches} mismatches')
+    return mismatches == 0
+
+
+def movegen_mismatch(board):
+    """
+    Input: Board object\n
+    Output: str describing the first piece whose legal moves differ from simulate_moves_for_checks(), or None
+    """
+    for team in ('white', 'black'):
+        for piece in board.all_pieces_on_team(team):
+            possible_moves = sorted(piece.all_possible_moves())
+            simulated_moves = sorted(simulate_moves_for_checks(piece, piece.moves_ignoring_checks()))
+            if possible_moves != simulated_moves:
+                return f'{piece!r} on {square_name(piece.position)} moves to {possible_moves} instead of {simulated_moves}'
+    return None
+
+
+def run_movegen_suite(game_count=20, max_plies=200, seed=20200531):
+    """
+    Inputs: optional int - random games to play, optional int - longest game, optional int - seed of the random moves\n
+    Output: Boolean - True if every piece's moves matched\n
+    Works out every piece's legal moves with the pins and checks found from the king, and again by making each move
+    and looking for a check, in every position in PERFT_SUITE and every position of some random games, and reports any
+    position where the two differ
+    """
+    board = Board()
+    rng = random.Random(seed)
+    positions = 0
+    mismatches = 0
+
+    def check(name):
+        nonlocal positions, mismatches
+        positions += 1
+        mismatch = movegen_mismatch(board)
+        if mismatch:
+            mismatches += 1
+            print(f'{name}: {mismatch}')
+
+    for name, fen, expected_counts in PERFT_SUITE:
+        board.load_fen(fen)
+        check(name)
+
+    for game in range(game_count):
+        initialize_board(board)
+        for ply in range(max_plies):
+            moves = all_legal_moves(board, board.turn)
+            if not moves:
+                break
+            board.make_move(*rng.choice(moves))
+            check(f'random game {game + 1} ply {ply + 1} ({board.to_fen()})')
+
+    print(f'{positions} positions checked, {mismatches} mismatches')
+    return mismatches == 0
+
+
+def evaluation_mismatch(board):
+    """
+    Input: Board object\n
+    Output: str describing how the board's running opening score, endgame score and game phase differ from
+            evaluate_material_and_position(), or None if they are the same
+    """
+    running_totals = (board.opening_score, board.endgame_score, board.game_phase)
+    totals = evaluate_material_and_position(board)
+    if running_totals != totals:
+        return f'running totals {running_totals} instead of {totals}'
+    return None
+
+
+def run_evaluation_suite(game_count=20, max_plies=200, seed=20200531):
+    """
+    Inputs: optional int - random games to play, optional int - longest game, optional int - seed of the random moves\n
+    Output: Boolean - True if the running totals always matched\n
+    In every position in PERFT_SUITE and every position of some random games, makes and unmakes every legal move
+    (promotions included) and checks the board's running evaluation totals against evaluate_material_and_position()
+    after each make and each unmake
+    """
+    board = Board()
+    rng = random.Random(seed)
+    positions = 0
+    mismatches = 0
+
+    def check(name):
+        nonlocal positions, mismatches
+        positions += 1
+        moves = all_legal_moves(board, board.turn)
+        mismatch = evaluation_mismatch(board)
+        for move in moves:
+            if mismatch:
+                break
+            undo = board.make_move(*move)
+            mismatch = evaluation_mismatch(board)
+            board.unmake_move(undo)
+            if mismatch:
+                mismatch = f'after {move}: {mismatch}'
+            else:
+                mismatch = evaluation_mismatch(board)
+                if mismatch:
+                    mismatch = f'after taking back {move}: {mismatch}'
+        if mismatch:
+            mismatches += 1
+            print(f'{name}: {mismatch}')
+        return moves
+
+    for name, fen, expected_counts in PERFT_SUITE:
+        board.load_fen(fen)
+        check(name)
+
+    for game in range(game_count):
+        initialize_board(board)
+        moves = check(f'random game {game + 1} start')
+        for ply in range(max_plies):
+            if not moves:
+                break
+            board.make_move(*rng.choice(moves))
+            moves = check(f'random game {game + 1} ply {ply + 1} ({board.to_fen()})')
+
+    print(f'{positions} positions checked, {mismatches} mismatches')
+    return mismatches == 0
+
+
+def count_bits(bitboard):
+    """
+    Input: int bitboard\n
+    Output: int - how many spaces are set
+    """
+    return bin(bitboard).count('1')
+
+
+def evaluate(board, team):
+    """
+    Inputs: Board object, str == either 'black' or 'white'\n
+    Output: int - score of the position in centipawns from the team's point of view\n
+    Material and piece-square scores come from the board's running totals. Mobility, pawn structure and king safety
+    are worked out from the bitboards. Opening and endgame scores are blended by how much material is left
+    """
+    opening_score = board.opening_score
+    endgame_score = board.endgame_score
+
+    pawn_score = evaluate_pawn_structure(board.bitboards[('white', Pawn)], board.bitboards[('black', Pawn)])
+    opening_score += pawn_score[0]
+    endgame_score += pawn_score[1]
+
+    occupied = board.occupied['white'] | board.occupied['black']
+    mobility = evaluate_mobility(board, 'white', occupied) - evaluate_mobility(board, 'black', occupied)
+    opening_score += mobility + evaluate_king_safety(board, 'white') - evaluate_king_safety(board, 'black')
+    endgame_score += mobility
+
+    phase = min(board.game_phase, GAME_PHASE_TOTAL)
+    score = (opening_score * phase + endgame_score * (GAME_PHASE_TOTAL - phase)) // GAME_PHASE_TOTAL
+    if team == 'white':
+        return score
+    return -score
+
+
+def evaluate_material_and_position(board):
+    """
+    Input: Board object\n
+    Output: (opening score, endgame score, game phase) worked out from scratch\n
+    What Board keeps up to date as pieces are added and removed. run_evaluation_suite() checks those running totals against it
+    """
+    opening_score = 0
+    endgame_score = 0
+    game_phase = 0
+    for row in board.positions:
+        for space in row:
+            if isinstance(space, Piece):
+                square = coords_to_square(space.position)
+                opening_score += OPENING_SCORES[(space.team, type(space))][square]
+                endgame_score += ENDGAME_SCORES[(space.team, type(space))][square]
+                game_phase += GAME_PHASE_WEIGHTS[type(space)]
+    return opening_score, endgame_score, game_phase
+
+
+def evaluate_mobility(board, team, occupied):
+    """
+    Inputs: Board object, str == either 'black' or 'white', bitboard of occupied spaces\n
+    Output: int - bonus for the spaces the team's knights, bishops, rooks and queens threaten that are not their own\n
+    Uses the bitboards, so it works on the boards the search moves pieces around on
+    """
+    not_allies = ~board.occupied[team]
+    score = 0
+    for square in bitboard_to_squares(board.bitboards[(team, Knight)]):
+        score += MOBILITY_WEIGHTS[Knight] * count_bits(KNIGHT_ATTACKS[square] & not_allies)
+    for square in bitboard_to_squares(board.bitboards[(team, Bishop)]):
+        score += MOBILITY_WEIGHTS[Bishop] * count_bits(sliding_attacks(square, occupied, DIAGONAL_DIRECTIONS) & not_allies)
+    for square in bitboard_to_squares(board.bitboards[(team, Rook)]):
+        score += MOBILITY_WEIGHTS[Rook] * count_bits(sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS) & not_allies)
+    for square in bitboard_to_squares(board.bitboards[(team, Queen)]):
+        score += MOBILITY_WEIGHTS[Queen] * count_bits(sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS) & not_allies)
+    return score
+
+
+def evaluate_pawn_structure(white_pawns, black_pawns):
+    """
+    Inputs: bitboard of white pawns, bitboard of black pawns\n
+    Output: (opening score, endgame score) of doubled, isolated and passed pawns, white minus black\n
+    Pawns move rarely, so scores are remembered for each pair of pawn bitboards
+    """
+    key = (white_pawns, black_pawns)
+    if key in PAWN_STRUCTURE_CACHE:
+        return PAWN_STRUCTURE_CACHE[key]
+
+    opening_score = 0
+    endgame_score = 0
+    for team, allies, enemies, sign in (('white', white_pawns, black_pawns, 1), ('black', black_pawns, white_pawns, -1)):
+        for column in range(8):
+            pawns_in_column = count_bits(allies & COLUMN_MASKS[column])
+            if pawns_in_column > 1:
+                opening_score -= sign * DOUBLED_PAWN_PENALTY[0] * (pawns_in_column - 1)
+                endgame_score -= sign * DOUBLED_PAWN_PENALTY[1] * (pawns_in_column - 1)
+            if pawns_in_column and not allies & ADJACENT_COLUMN_MASKS[column]:
+                opening_score -= sign * ISOLATED_PAWN_PENALTY[0] * pawns_in_column
+                endgame_score -= sign * ISOLATED_PAWN_PENALTY[1] * pawns_in_column
+        for square in bitboard_to_squares(allies):
+            if not enemies & PASSED_PAWN_MASKS[team][square]:
+                # Rows left to go before the pawn reaches the other side
+                rows_to_go = square // 8 if team == 'white' else 7 - square // 8
+                opening_score += sign * PASSED_PAWN_BONUS[0][rows_to_go]
+                endgame_score += sign * PASSED_PAWN_BONUS[1][rows_to_go]
+
+    if len(PAWN_STRUCTURE_CACHE) >= PAWN_STRUCTURE_CACHE_SIZE:
+        PAWN_STRUCTURE_CACHE.clear()
+    PAWN_STRUCTURE_CACHE[key] = (opening_score, endgame_score)
+    return opening_score, endgame_score
+
+
+def evaluate_king_safety(board, team):
+    """
+    Inputs: Board object, str == either 'black' or 'white'\n
+    Output: int - bonus for the pawns sheltering the team's king, minus a penalty for each column around it with none
+    of them. Only counts in the opening, evaluate() blends it out as pieces come off
+    """
+    king_bitboard = board.bitboards[(team, King)]
+    if not king_bitboard:
+        return 0
+    king_square = king_bitboard.bit_length() - 1
+    pawns = board.bitboards[(team, Pawn)]
+    score = KING_SHELTER_BONUS * count_bits(pawns & KING_SHELTER_MASKS[team][king_square])
+    for column_mask in KING_COLUMN_MASKS[king_square]:
+        if not pawns & column_mask:
+            score -= OPEN_KING_COLUMN_PENALTY
+    return score
+
+
+def encode_move(move):
+    """
+    Input: (selected position, destination position, promotion)\n
+    Output: int - the move packed as from square + to square * 64 + promotion * 4096
+    """
+    selected_position, destination_position, promotion = move
+    code = coords_to_square(selected_position) | coords_to_square(destination_position) << 6
+    if promotion:
+        code |= (PROMOTION_CHOICES.index(promotion) + 1) << 12
+    return code
+
+
+def decode_move(code):
+    """
+    Input: int from encode_move()\n
+    Output: (selected position, destination position, promotion)
+    """
+    promotion = None
+    if code >> 12:
+        promotion = PROMOTION_CHOICES[(code >> 12) - 1]
+    return SQUARE_COORDS[code & 63], SQUARE_COORDS[code >> 6 & 63], promotion
+
+
+class TranspositionTable():
+    "Fixed size table of search results, indexed by the position's Zobrist hash"
+
+    # Bytes used by one entry: key, depth, bound, score, move and age
+    ENTRY_SIZE = 8 + 1 + 1 + 4 + 4 + 1
+
+    def __init__(self, size_mb=16):
+        # Every bucket has two entries, the first keeps the deepest result and the second always takes the newest one
+        self.buckets = max(1, int(size_mb * 1024 * 1024) // (self.ENTRY_SIZE * 2))
+        entries = self.buckets * 2
+        self.keys = array('Q', bytes(8 * entries))
+        self.depths = array('b', bytes(entries))
+        self.bounds = array('B', bytes(entries))
+        self.scores = array('i', bytes(4 * entries))
+        self.moves = array('I', bytes(4 * entries))
+        self.ages = array('B', bytes(entries))
+
+        # Entries from older searches are replaced before deeper ones from this search
+        self.age = 0
+
+    def new_search(self):
+        """
+        Marks every stored entry as belonging to an older search
+        """
+        self.age = (self.age + 1) % 256
+
+    def probe(self, key):
+        """
+        Input: int - Zobrist hash\n
+        Output: (depth, bound, score, move code) or None if the position is not stored
+        """
+        index = key % self.buckets * 2
+        for entry in (index, index + 1):
+            if self.keys[entry] == key and self.bounds[entry] != BOUND_NONE:
+                return self.depths[entry], self.bounds[entry], self.scores[entry], self.moves[entry]
+        return None
+
+    def store(self, key, depth, bound, score, move_code):
+        """
+        Inputs: int Zobrist hash, int depth searched, int bound type, int score, int move code (0 for none)\n
+        Saves a search result, keeping the deepest result of the current search in the first entry
+        """
+        entry = key % self.buckets * 2
+        if self.bounds[entry] != BOUND_NONE and self.keys[entry] != key and self.ages[entry] == self.age and depth < self.depths[entry]:
+            entry += 1
+
+        self.keys[entry] = key
+        self.depths[entry] = max(-128, min(127, depth))
+        self.bounds[entry] = bound
+        self.scores[entry] = score
+        self.moves[entry] = move_code
+        self.ages[entry] = self.age
+
+
+class SearchTimeout(Exception):
+    "Raised inside the search when the time or node budget runs out"
+
+
+class Engine():
+    "Negamax alpha-beta search with iterative deepening that picks the moves for one side"
+
+    def __init__(self, time_limit=2.0, node_limit=None, max_depth=64, hash_size_mb=16, workers=1, book=None, tablebase=None):
+        # Budget for one move. The deepest search that finished in time is used
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.max_depth = max_depth
+
+        # Results of earlier searches, kept between moves
+        self.hash_size_mb = hash_size_mb
+        self.transposition_table = TranspositionTable(hash_size_mb)
+
+        # With more than one worker the root moves are split between that many processes,
+        # each with its own copy of the board, its own budget and its own transposition table
+        self.workers = workers
+        self.executor = None
+
+        # OpeningBook to play from before searching, if there is one. from_book tells if the last move came from it
+        self.book = book
+        self.from_book = False
+
+        # Tablebase that gives exact scores for positions with few pieces, if there is one
+        self.tablebase = tablebase
+
+        # How many times each position is on the path from the root, to spot repetitions inside the search
+        self.path_counts = Counter()
+
+        # Quiet moves that caused a cutoff, two per ply (killer moves)
+        self.killers = []
+
+        # How often a quiet move (code) caused a cutoff anywhere in the tree (history heuristic)
+        self.history = {}
+
+        # Statistics of the last search
+        self.nodes = 0
+        self.depth_reached = 0
+        self.score = 0
+        self.deadline = None
+
+        # (score, best move code) of every depth the last search finished, shallowest first
+        self.iterations = []
+
+    def choose_move(self, board, team, root_moves=None):
+        """
+        Inputs: Board object, str == either 'black' or 'white', optional list of move codes to choose from\n
+        Output: (selected position, destination position, promotion) or None if there are no legal moves\n
+        Searches one ply deeper at a time until the time or node budget runs out
+        """
+        if root_moves is None:
+            root_moves = generate_move_codes(board, team)
+        else:
+            root_moves = list(root_moves)
+        if not root_moves:
+            return None
+
+        self.from_book = False
+        self.iterations = []
+        if self.book is not None:
+            book_move = self.book.choose_move(board, root_moves)
+            if book_move is not None:
+                self.from_book = True
+                self.nodes = 0
+                self.depth_reached = 0
+                return decode_move(book_move)
+
+        if self.workers > 1 and len(root_moves) > 1:
+            return self.choose_move_in_parallel(board, team, root_moves)
+
+        self.nodes = 0
+        self.depth_reached = 0
+        self.score = -INFINITE_SCORE
+        self.killers = [[None, None] for _ in range(self.max_depth + 64)]
+        self.history = {}
+        self.path_counts = Counter([board.hash])
+        self.transposition_table.new_search()
+        self.deadline = None
+        if self.time_limit is not None:
+            self.deadline = time.perf_counter() + self.time_limit
+
+        best_move = root_moves[0]
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, move = self.search_root(board, team, root_moves, depth)
+            except SearchTimeout:
+                break
+            best_move = move
+            self.score = score
+            self.depth_reached = depth
+            self.iterations.append((score, move))
+
+            # Search the best move first next time, it makes the cutoffs come sooner
+            root_moves.remove(move)
+            root_moves.insert(0, move)
+
+            # A forced mate will not get any better by searching deeper
+            if abs(score) >= MATE_SCORE - self.max_depth:
+                break
+
+        return decode_move(best_move)
+
+    def choose_move_in_parallel(self, board, team, root_moves):
+        """
+        Inputs: Board object, str == either 'black' or 'white', list of move codes\n
+        Output: (selected position, destination position, promotion)\n
+        Deals the root moves out to the worker processes (most promising moves spread evenly) and
+        keeps the one with the best score. Scores are only compared at the deepest depth every worker finished,
+        since a deeper search of one move can not be weighed against a shallower search of another. Workers do
+        not share alpha-beta bounds, so the speedup is less than the number of workers
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.killers = [[None, None] for _ in range(self.max_depth + 64)]
+        ordered_moves = self.order_moves(board, root_moves, 0)
+        tablebase_directory = self.tablebase.directory if self.tablebase is not None else None
+        futures = []
+        for worker in range(self.workers):
+            worker_moves = ordered_moves[worker::self.workers]
+            if worker_moves:
+                futures.append(self.executor.submit(search_root_moves, board, team, worker_moves, self.time_limit,
+                                                    self.node_limit, self.max_depth, self.hash_size_mb, tablebase_directory))
+
+        results = [future.result() for future in futures]
+        self.nodes = sum(result[3] for result in results)
+
+        # A worker that did not finish even one depth has no score for its moves, so it is left out.
+        # If none finished, the most promising move is played
+        iterations = [result[4] for result in results if result[4]]
+        if not iterations:
+            self.score = -INFINITE_SCORE
+            self.depth_reached = 0
+            self.iterations = []
+            return decode_move(ordered_moves[0])
+
+        self.depth_reached = min(len(worker_iterations) for worker_iterations in iterations)
+        self.iterations = []
+        for depth in range(self.depth_reached):
+            self.iterations.append(max((worker_iterations[depth] for worker_iterations in iterations), key=lambda iteration: iteration[0]))
+        self.score, best_move = self.iterations[-1]
+        return decode_move(best_move)
+
+    def close(self):
+        """
+        Stops the worker processes, if there are any
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def search_root(self, board, team, root_moves, depth):
+        """
+        Inputs: Board object, str == either 'black' or 'white', list of legal move codes, int\n
+        Output: (score, best move code)
+        """
+        opposite_team = other_team(team)
+        alpha = -INFINITE_SCORE
+        best_move = root_moves[0]
+        for move in root_moves:
+            undo = board.make_move_code(move)
+            try:
+                score = -self.negamax(board, opposite_team, depth - 1, -INFINITE_SCORE, -alpha, 1)
+            finally:
+                board.unmake_move(undo)
+            if score > alpha:
+                alpha = score
+                best_move = move
+        self.transposition_table.store(board.hash, depth, BOUND_EXACT, alpha, best_move)
+        return alpha, best_move
+
+    def negamax(self, board, team, depth, alpha, beta, ply):
+        """
+        Inputs: Board object, str == either 'black' or 'white', int depth left, int alpha, int beta, int ply from the root\n
+        Output: int - score from the team's point of view
+        """
+        # A position that already happened in the game or on this path is heading for a draw
+        if self.path_counts[board.hash] or board.position_counts[board.hash]:
+            return 0
+
+        if self.tablebase is not None:
+            tablebase_score = self.tablebase.score(board, team, ply)
+            if tablebase_score is not None:
+                return tablebase_score
+
+        if depth <= 0:
+            return self.quiescence(board, team, alpha, beta, ply)
+        self.count_node()
+
+        # A result from an earlier search that went deep enough can be reused
+        best_move_code = 0
+        entry = self.transposition_table.probe(board.hash)
+        if entry:
+            entry_depth, bound, entry_score, best_move_code = entry
+            entry_score = score_from_table(entry_score, ply)
+            if entry_depth >= depth:
+                if bound == BOUND_EXACT:
+                    return entry_score
+                if bound == BOUND_LOWER and entry_score >= beta:
+                    return entry_score
+                if bound == BOUND_UPPER and entry_score <= alpha:
+                    return entry_score
+
+        moves = generate_move_codes(board, team)
+        if not moves:
+            return self.score_without_moves(board, team, ply)
+
+        original_alpha = alpha
+        best_move = None
+        opposite_team = other_team(team)
+        self.path_counts[board.hash] += 1
+        try:
+            for move in self.order_moves(board, moves, ply, best_move_code):
+                undo = board.make_move_code(move)
+                try:
+                    score = -self.negamax(board, opposite_team, depth - 1, -beta, -alpha, ply + 1)
+                finally:
+                    board.unmake_move(undo)
+
+                if score >= beta:
+                    # Remember quiet moves that refute the opponent's move, they will likely work again
+                    if not board.squares[move >> 6 & 63]:
+                        if self.killers[ply][0] != move:
+                            self.killers[ply][1] = self.killers[ply][0]
+                            self.killers[ply][0] = move
+                        self.history[move] = self.history.get(move, 0) + depth * depth
+                    self.transposition_table.store(board.hash, depth, BOUND_LOWER, score_to_table(beta, ply), move)
+                    return beta
+                if score > alpha:
+                    alpha = score
+                    best_move = move
+        finally:
+            self.path_counts[board.hash] -= 1
+
+        if alpha > original_alpha:
+            self.transposition_table.store(board.hash, depth, BOUND_EXACT, score_to_table(alpha, ply), best_move)
+        else:
+            self.transposition_table.store(board.hash, depth, BOUND_UPPER, score_to_table(alpha, ply), 0)
+        return alpha
+
+    def quiescence(self, board, team, alpha, beta, ply):
+        """
+        Inputs: Board object, str == either 'black' or 'white', int alpha, int beta, int ply from the root\n
+        Output: int - score from the team's point of view\n
+        Only looks at captures and promotions so the search never stops in the middle of an exchange
+        """
+        self.count_node()
+
+        moves = generate_move_codes(board, team)
+        if not moves:
+            return self.score_without_moves(board, team, ply)
+
+        standing_score = evaluate(board, team)
+        if standing_score >= beta:
+            return beta
+        if standing_score > alpha:
+            alpha = standing_score
+
+        opposite_team = other_team(team)
+        captures = [move for move in moves if move >> 12 or board.squares[move >> 6 & 63]]
+        for move in self.order_moves(board, captures, ply):
+            undo = board.make_move_code(move)
+            try:
+                score = -self.quiescence(board, opposite_team, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake_move(undo)
+
+            if score >= beta:
+                return beta
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def order_moves(self, board, moves, ply, best_move_code=0):
+        """
+        Inputs: Board object, list of move codes, int ply from the root, optional int move code of the best move found before\n
+        Output: list of move codes, most promising first\n
+        The best move from the transposition table comes first, then captures of the most valuable victim
+        by the least valuable attacker (MVV-LVA), then the killer moves of this ply, then quiet moves by their history score
+        """
+        killers = self.killers[ply]
+        squares = board.squares
+
+        def move_priority(move):
+            if move == best_move_code:
+                return 3000000
+            victim = squares[move >> 6 & 63]
+            if victim or move >> 12:
+                victim_value = CODE_VALUES[victim]
+                if move >> 12:
+                    victim_value += PIECE_VALUES[PROMOTION_CHOICES[(move >> 12) - 1]]
+                return 2000000 + victim_value * 10 - CODE_VALUES[squares[move & 63]] // 10
+            if move == killers[0]:
+                return 1000001
+            if move == killers[1]:
+                return 1000000
+            return self.history.get(move, 0)
+
+        return sorted(moves, key=move_priority, reverse=True)
+
+    def score_without_moves(self, board, team, ply):
+        """
+        Inputs: Board object, str == either 'black' or 'white', int ply from the root\n
+        Output: int - a lost score if checkmated (sooner mates are worse), 0 for stalemate
+        """
+        if find_pins_and_checks(board, team)[1]:
+            return -MATE_SCORE + ply
+        return 0
+
+    def count_node(self):
+        """
+        Counts a searched position and stops the search once the budget runs out
+        """
+        self.nodes += 1
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchTimeout()
+        if self.deadline is not None and self.nodes % 64 == 0 and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+
+def search_root_moves(board, team, root_moves, time_limit, node_limit, max_depth, hash_size_mb, tablebase_directory=None):
+    """
+    Inputs: Board object (a copy), str == either 'black' or 'white', list of move codes, the Engine budget,
+            optional str - directory of tablebase files\n
+    Output: (score, best move code, depth reached, nodes searched, list of (score, best move code) of every depth finished)\n
+    Runs in a worker process for Engine.choose_move_in_parallel(). The worker maps the tablebase files itself,
+    since an open Tablebase can not be sent to another process
+    """
+    tablebase = None
+    if tablebase_directory:
+        tablebase = Tablebase(tablebase_directory)
+    engine = Engine(time_limit, node_limit, max_depth, hash_size_mb, tablebase=tablebase)
+    try:
+        move = engine.choose_move(board, team, root_moves)
+    finally:
+        if tablebase is not None:
+            tablebase.close()
+    return engine.score, encode_move(move), engine.depth_reached, engine.nodes, engine.iterations
+
+
+def compare_parallel_search(depth, workers):
+    """
+    Inputs: int depth, int number of worker processes\n
+    Output: float - how many times faster the parallel search was\n
+    Searches a few positions to the same depth with one process and with the workers and prints the times
+    """
+    positions = [
+        STARTING_FEN,
+        'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+        '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    ]
+    elapsed = {}
+    for worker_count in (1, workers):
+        engine = Engine(time_limit=None, max_depth=depth, workers=worker_count)
+        start_time = time.perf_counter()
+        for fen in positions:
+            board = Board()
+            board.load_fen(fen)
+            engine.choose_move(board, board.turn)
+        elapsed[worker_count] = time.perf_counter() - start_time
+        engine.close()
+        print(f'{worker_count} process(es): {elapsed[worker_count]:.2f}s')
+
+    speedup = elapsed[1] / max(elapsed[workers], 1e-9)
+    print(f'speedup with {workers} processes: {speedup:.2f}x')
+    return speedup
+
+
+def score_to_table(score, ply):
+    """
+    Inputs: int score, int ply from the root\n
+    Output: int - the score with mates counted from this position instead of from the root
+    """
+    if score >= MATE_SCORE - 1000:
+        return score + ply
+    if score <= -MATE_SCORE + 1000:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    """
+    Inputs: int score from the transposition table, int ply from the root\n
+    Output: int - the score with mates counted from the root again
+    """
+    if score >= MATE_SCORE - 1000:
+        return score - ply
+    if score <= -MATE_SCORE + 1000:
+        return score + ply
+    return score
+
+
+def other_team(team):
+    """
+    Input: str == either 'black' or 'white'\n
+    Output: str - the other team
+    """
+    if team == 'white':
+        return 'black'
+    return 'white'
+
+
+class OpeningBook():
+    "Moves to play in positions from the start of games, read from a memory-mapped file written by build_opening_book()"
+
+    def __init__(self, path):
+        # The file is a header then entries sorted by (position hash, move). Only the pages that are looked at get read
+        with open(path, 'rb') as book_file:
+            self.book_map = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.entry_count = BOOK_HEADER.unpack_from(self.book_map, 0)
+        if magic != BOOK_MAGIC or BOOK_HEADER.size + self.entry_count * BOOK_ENTRY.size > len(self.book_map):
+            self.book_map.close()
+            raise ValueError(f"{path} is not an opening book")
+
+    def probe(self, board):
+        """
+        Input: Board object\n
+        Output: list of (move code, weight) for the position, empty if it is not in the book
+        """
+        position_hash = board.hash
+        low = 0
+        high = self.entry_count
+        while low < high:
+            middle = (low + high) // 2
+            if BOOK_ENTRY.unpack_from(self.book_map, BOOK_HEADER.size + middle * BOOK_ENTRY.size)[0] < position_hash:
+                low = middle + 1
+            else:
+                high = middle
+
+        moves = []
+        for entry in range(low, self.entry_count):
+            entry_hash, code, weight = BOOK_ENTRY.unpack_from(self.book_map, BOOK_HEADER.size + entry * BOOK_ENTRY.size)
+            if entry_hash != position_hash:
+                break
+            moves.append((code, weight))
+        return moves
+
+    def choose_move(self, board, legal_moves, rng=random):
+        """
+        Inputs: Board object, list of move codes the move must be one of, optional random.Random\n
+        Output: move code picked at random in proportion to the weights, or None if the book has no move here
+        """
+        moves = [(code, weight) for code, weight in self.probe(board) if code in legal_moves]
+        if not moves:
+            return None
+        pick = rng.randrange(sum(weight for _, weight in moves))
+        for code, weight in moves:
+            pick -= weight
+            if pick < 0:
+                return code
+
+    def close(self):
+        """
+        Unmaps the file
+        """
+        self.book_map.close()
+
+
+def build_opening_book(pgn_paths, book_path, max_plies=16):
+    """
+    Inputs: list of str - paths of PGN files, str - path of the book to write, optional int - moves per game to add\n
+    Output: int - number of (position, move) entries written\n
+    Replays the start of every game like replay_pgn_games() and weighs each move by how often it was played.
+    Games stop adding moves at their first illegal move
+    """
+    counts = {}
+    board = Board()
+    for pgn_path in pgn_paths:
+        with open(pgn_path, encoding='utf-8', errors='replace') as pgn_file:
+            for tags, moves, result in read_pgn_games(pgn_file):
+                try:
+                    if 'FEN' in tags:
+                        board.load_fen(tags['FEN'])
+                    else:
+                        initialize_board(board)
+                except ValueError:
+                    continue
+
+                for san in moves[:max_plies]:
+                    move = san_to_move(board, board.turn, san)
+                    if move is None:
+                        break
+                    selected_position, destination_position, evolution = move
+                    promotion = PROMOTION_NAMES[evolution] if evolution else None
+                    key = (board.hash, encode_move((selected_position, destination_position, promotion)))
+                    counts[key] = counts.get(key, 0) + 1
+                    check_then_move(board, selected_position, destination_position, board.turn)
+                    if evolution:
+                        board.coords_to_piece(destination_position).check_evolve(evolution)
+
+    with open(book_path, 'wb') as book_file:
+        book_file.write(BOOK_HEADER.pack(BOOK_MAGIC, len(counts)))
+        for (position_hash, code), count in sorted(counts.items()):
+            book_file.write(BOOK_ENTRY.pack(position_hash, code, min(count, 65535)))
+    return len(counts)
+
+
+class Tablebase():
+    "Endgame tables for positions with a few pieces, memory-mapped from the files generate_tablebase() writes"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        # Memory-mapped table of each material signature that has been looked at, None if there is no file for it
+        self.tables = {}
+
+    def table(self, signature):
+        """
+        Input: str - material signature (i.e. 'KQvK')\n
+        Output: the table (a buffer with one byte per position after the header), or None if it was not generated
+        """
+        if signature not in self.tables:
+            table = None
+            path = os.path.join(self.directory, signature + '.tb')
+            if os.path.exists(path):
+                with open(path, 'rb') as table_file:
+                    table = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if TABLEBASE_HEADER.unpack_from(table, 0)[0] != TABLEBASE_MAGIC:
+                    table.close()
+                    raise ValueError(f"{path} is not a tablebase")
+            self.tables[signature] = table
+        return self.tables[signature]
+
+    def value(self, board, team):
+        """
+        Inputs: Board object, str == either 'black' or 'white' - the team to move\n
+        Output: int - the position's byte in its table, or None if there is no table for it
+        """
+        if count_bits(board.occupied['white'] | board.occupied['black']) > TABLEBASE_MAX_PIECES:
+            return None
+        pieces = []
+        for (piece_team, piece_type), bitboard in board.bitboards.items():
+            for square in bitboard_to_squares(bitboard):
+                pieces.append((piece_team, piece_type, square))
+        return self.value_of(pieces, team)
+
+    def value_of(self, pieces, team):
+        """
+        Inputs: list of (team, Piece class, square), str - the team to move\n
+        Output: int - the position's byte in its table, or None if there is no table for it
+        """
+        signature, index = tablebase_index(pieces, team)
+        table = self.table(signature)
+        if table is None:
+            return None
+        return table[TABLEBASE_HEADER.size + index]
+
+    def probe(self, board, team):
+        """
+        Inputs: Board object, str == either 'black' or 'white' - the team to move\n
+        Output: None if there is no table for the position. Otherwise (1 for a win, 0 for a draw or -1 for a loss for the
+                team, int - moves by both teams until checkmate, 0 for a draw)
+        """
+        value = self.value(board, team)
+        if value is None or value == TABLEBASE_ILLEGAL:
+            return None
+        if value in (TABLEBASE_DRAW, TABLEBASE_STALEMATE):
+            return 0, 0
+        plies = value - 1
+        if plies % 2:
+            return 1, plies
+        return -1, plies
+
+    def score(self, board, team, ply):
+        """
+        Inputs: Board object, str == either 'black' or 'white' - the team to move, int ply from the search's root\n
+        Output: search score of the position like Engine.negamax() gives, or None if there is no table for it
+        """
+        result = self.probe(board, team)
+        if result is None:
+            return None
+        outcome, plies = result
+        if outcome > 0:
+            return MATE_SCORE - ply - plies
+        if outcome < 0:
+            return -MATE_SCORE + ply + plies
+        return 0
+
+    def close(self):
+        """
+        Unmaps every table
+        """
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+        self.tables = {}
+
+
+def material_signature(pieces):
+    """
+    Input: list of (team, Piece class, square)\n
+    Output: str - the pieces each team has, white first (i.e. 'KQvK')
+    """
+    letters = {'white': '', 'black': ''}
+    for piece_type in (King, Queen, Rook, Bishop, Knight, Pawn):
+        for team in ('white', 'black'):
+            letters[team] += FEN_LETTERS[piece_type].upper() * sum(1 for piece in pieces if piece[0] == team and piece[1] is piece_type)
+    return letters['white'] + 'v' + letters['black']
+
+
+def signature_is_flipped(signature):
+    """
+    Input: str - material signature\n
+    Output: Boolean - True if black has more material, the table is kept with the teams swapped
+    """
+    white_letters, black_letters = signature.split('v')
+
+    def strength(letters):
+        return sum(PIECE_VALUES[FEN_PIECES[letter.lower()]] for letter in letters), letters
+    return strength(black_letters) > strength(white_letters)
+
+
+def tablebase_pieces(signature):
+    """
+    Input: str - material signature\n
+    Output: list of (team, Piece class) in the order their spaces make up the table index
+    """
+    white_letters, black_letters = signature.split('v')
+    return [('white', FEN_PIECES[letter.lower()]) for letter in white_letters] + \
+           [('black', FEN_PIECES[letter.lower()]) for letter in black_letters]
+
+
+def tablebase_index(pieces, team):
+    """
+    Inputs: list of (team, Piece class, square), str - the team to move\n
+    Output: (str - material signature of the table, int - index of the position in it)\n
+    Positions where black has more material are flipped upside down with the teams swapped
+    """
+    signature = material_signature(pieces)
+    if signature_is_flipped(signature):
+        pieces = [(other_team(piece_team), piece_type, square ^ 56) for piece_team, piece_type, square in pieces]
+        team = other_team(team)
+        signature = material_signature(pieces)
+
+    remaining = list(pieces)
+    index = 1 if team == 'black' else 0
+    for piece_team, piece_type in tablebase_pieces(signature):
+        for piece in remaining:
+            if piece[0] == piece_team and piece[1] is piece_type:
+                remaining.remove(piece)
+                index = index * 64 + piece[2]
+                break
+    return signature, index
+
+
+def tablebase_attacks(piece_type, team, square, occupied):
+    """
+    Inputs: Piece class, str == either 'black' or 'white', int square, bitboard of occupied spaces\n
+    Output: bitboard of the spaces the piece threatens
+    """
+    if piece_type is Pawn:
+        return PAWN_ATTACKS[team][square]
+    if piece_type is Knight:
+        return KNIGHT_ATTACKS[square]
+    if piece_type is King:
+        return KING_ATTACKS[square]
+    if piece_type is Bishop:
+        return sliding_attacks(square, occupied, DIAGONAL_DIRECTIONS)
+    if piece_type is Rook:
+        return sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS)
+    return sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS)
+
+
+def generate_tablebase(signature, directory, tablebase=None):
+    """
+    Inputs: str - material signature of up to TABLEBASE_MAX_PIECES pieces with one king each (i.e. 'KQvK', 'KRvKP'),
+            str - directory the table files go in, optional Tablebase reading that directory\n
+    Output: Tablebase that can probe the new table\n
+    Retrograde analysis: every legal position counts its moves, then the search works backwards from the checkmates one
+    ply at a time. A position with a move to a lost position is won, a position whose moves all lead to won positions is
+    lost. Positions never reached are draws. Captures and promotions lead into smaller tables, which are generated first.
+    Each position gets one byte: 0 for a draw, TABLEBASE_STALEMATE, TABLEBASE_ILLEGAL, otherwise plies to checkmate + 1
+    (an odd number of plies is a win for the team to move, an even one a loss). 3 pieces take seconds to a minute,
+    4 pieces take much longer
+    """
+    if tablebase is None:
+        tablebase = Tablebase(directory)
+    pieces = tablebase_pieces(signature)
+    if signature_is_flipped(signature):
+        signature = material_signature([(other_team(team), piece_type, 0) for team, piece_type in pieces])
+        pieces = tablebase_pieces(signature)
+    if len(pieces) > TABLEBASE_MAX_PIECES or [piece_type for _, piece_type in pieces].count(King) != 2 or \
+            signature.split('v')[0][0] != 'K' or signature.split('v')[1][0] != 'K':
+        raise ValueError(f"can not make a tablebase for {signature}")
+    if tablebase.table(signature) is not None:
+        return tablebase
+
+    # Smaller tables that captures and promotions lead to
+    for captured in range(len(pieces)):
+        if pieces[captured][1] is not King:
+            smaller = [(team, piece_type, 0) for team, piece_type in pieces[:captured] + pieces[captured + 1:]]
+            generate_tablebase(material_signature(smaller), directory, tablebase)
+    for promoted in range(len(pieces)):
+        if pieces[promoted][1] is Pawn:
+            for evolution in PROMOTION_CHOICES:
+                for captured in range(len(pieces)):
+                    if captured == promoted or pieces[captured][1] is King:
+                        continue
+                    smaller = [(team, evolution if number == promoted else piece_type, 0)
+                               for number, (team, piece_type) in enumerate(pieces) if number != captured]
+                    generate_tablebase(material_signature(smaller), directory, tablebase)
+                bigger = [(team, evolution if number == promoted else piece_type, 0) for number, (team, piece_type) in enumerate(pieces)]
+                generate_tablebase(material_signature(bigger), directory, tablebase)
+
+    piece_count = len(pieces)
+    side_size = 64 ** piece_count
+    values = bytearray(2 * side_size)
+    # Powers of 64 each piece's square is multiplied by in the index
+    weights = [64 ** (piece_count - 1 - number) for number in range(piece_count)]
+    kings = {team: number for number, (team, piece_type) in enumerate(pieces) if piece_type is King}
+
+    def in_check(squares, team, occupied):
+        king_square = squares[kings[team]]
+        for number, (piece_team, piece_type) in enumerate(pieces):
+            if piece_team != team and tablebase_attacks(piece_type, piece_team, squares[number], occupied) >> king_square & 1:
+                return True
+        return False
+
+    # Legal positions: no two pieces on a space, no pawns on the first or last row, the team that just moved is not in check
+    for side, team in enumerate(('white', 'black')):
+        for offset, squares in enumerate(itertools.product(range(64), repeat=piece_count)):
+            index = side * side_size + offset
+            occupied = 0
+            for square in squares:
+                occupied |= 1 << square
+            if count_bits(occupied) != piece_count or \
+                    any(piece_type is Pawn and squares[number] // 8 in (0, 7) for number, (_, piece_type) in enumerate(pieces)) or \
+                    in_check(squares, other_team(team), occupied):
+                values[index] = TABLEBASE_ILLEGAL
+
+    # Moves of every legal position. Moves within this table are counted, captures and promotions are looked up.
+    # exits holds the longest loss through a capture or promotion, or 255 when one of those draws or wins
+    remaining = bytearray(2 * side_size)
+    exits = bytearray(2 * side_size)
+    levels = {}
+    for side, team in enumerate(('white', 'black')):
+        for offset, squares in enumerate(itertools.product(range(64), repeat=piece_count)):
+            index = side * side_size + offset
+            if values[index] == TABLEBASE_ILLEGAL:
+                continue
+            occupied = 0
+            allies = 0
+            for number, square in enumerate(squares):
+                occupied |= 1 << square
+                if pieces[number][0] == team:
+                    allies |= 1 << square
+            quickest_win = None
+            has_moves = False
+            for number, (piece_team, piece_type) in enumerate(pieces):
+                if piece_team != team:
+                    continue
+                square = squares[number]
+                if piece_type is Pawn:
+                    step = PAWN_STEPS[team]
+                    targets = PAWN_ATTACKS[team][square] & occupied & ~allies
+                    if not occupied >> (square + step) & 1:
+                        targets |= 1 << (square + step)
+                        if square // 8 == PAWN_STARTING_ROWS[team] and not occupied >> (square + 2 * step) & 1:
+                            targets |= 1 << (square + 2 * step)
+                else:
+                    targets = tablebase_attacks(piece_type, team, square, occupied) & ~allies
+                for target in bitboard_to_squares(targets):
+                    promotes = piece_type is Pawn and target // 8 in (0, 7)
+                    if not occupied >> target & 1 and not promotes:
+                        child = (1 - side) * side_size + index % side_size + (target - square) * weights[number]
+                        if values[child] != TABLEBASE_ILLEGAL:
+                            remaining[index] += 1
+                            has_moves = True
+                        continue
+
+                    # Captures and promotions
+                    for evolution in (PROMOTION_CHOICES if promotes else [piece_type]):
+                        child_pieces = [(child_team, evolution if other == number else child_type, target if other == number else squares[other])
+                                        for other, (child_team, child_type) in enumerate(pieces) if squares[other] != target or other == number]
+                        child_value = tablebase.value_of(child_pieces, other_team(team))
+                        if child_value == TABLEBASE_ILLEGAL:
+                            continue
+                        has_moves = True
+                        if child_value in (TABLEBASE_DRAW, TABLEBASE_STALEMATE):
+                            exits[index] = 255
+                        elif (child_value - 1) % 2 == 0:
+                            # The other team is lost there, so this is a win
+                            exits[index] = 255
+                            if quickest_win is None or child_value < quickest_win:
+                                quickest_win = child_value
+                        elif exits[index] != 255:
+                            exits[index] = max(exits[index], child_value)
+
+            if quickest_win is not None:
+                levels.setdefault(quickest_win, []).append((index, True))
+            elif not has_moves:
+                if in_check(squares, team, occupied):
+                    levels.setdefault(0, []).append((index, False))
+                else:
+                    values[index] = TABLEBASE_STALEMATE
+            elif not remaining[index] and exits[index] != 255:
+                levels.setdefault(exits[index], []).append((index, False))
+
+    # Work backwards one ply at a time from the checkmates
+    level = 0
+    while levels:
+        for index, won in levels.pop(level, []):
+            if values[index]:
+                continue
+            values[index] = level + 1
+            side = index // side_size
+            team = ('white', 'black')[side]
+            moved_team = other_team(team)
+            squares = [index // weight % 64 for weight in weights]
+            occupied = 0
+            for square in squares:
+                occupied |= 1 << square
+
+            # Undo each move the other team could have made to get here
+            for number, (piece_team, piece_type) in enumerate(pieces):
+                if piece_team != moved_team:
+                    continue
+                square = squares[number]
+                if piece_type is Pawn:
+                    step = PAWN_STEPS[moved_team]
+                    sources = 0
+                    if not occupied >> (square - step) & 1 and (square - step) // 8 not in (0, 7):
+                        sources |= 1 << (square - step)
+                        if (square - 2 * step) // 8 == PAWN_STARTING_ROWS[moved_team] and not occupied >> (square - 2 * step) & 1:
+                            sources |= 1 << (square - 2 * step)
+                else:
+                    sources = tablebase_attacks(piece_type, moved_team, square, occupied) & ~occupied
+                for source in bitboard_to_squares(sources):
+                    parent = (1 - side) * side_size + index % side_size + (source - square) * weights[number]
+                    if values[parent]:
+                        continue
+                    if not won:
+                        levels.setdefault(level + 1, []).append((parent, True))
+                    else:
+                        remaining[parent] -= 1
+                        if not remaining[parent] and exits[parent] != 255:
+                            levels.setdefault(max(level + 1, exits[parent]), []).append((parent, False))
+        level += 1
+        if level >= TABLEBASE_STALEMATE - 1:
+            raise ValueError(f"{signature} has mates too long to store")
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, signature + '.tb'), 'wb') as table_file:
+        table_file.write(TABLEBASE_HEADER.pack(TABLEBASE_MAGIC, piece_count))
+        table_file.write(values)
+    tablebase.tables.pop(signature, None)
+    return tablebase
+
+
+def play_computer_move(board, engine, player, player_color):
+    """
+    Inputs: Board object, Engine object, str == "white" or "black", str - color shown to the players\n
+    Output: Boolean - True if the computer moved\n
+    Lets the engine pick a move and plays it through the same checks a player's move goes through
+    """
+    move = engine.choose_move(board, player)
+    if move is None:
+        return False
+    selected_position, destination_position, promotion = move
+
+    print(f"{player_color.upper()} MOVES: {coords_to_input(selected_position)} to {coords_to_input(destination_position)}")
+    if engine.from_book:
+        print("(from the opening book)")
+    else:
+        print(f"(searched {engine.depth_reached} moves ahead, {engine.nodes} positions)")
+    player_move_completed = check_then_move(board, selected_position, destination_position, player)
+    if promotion:
+        pawn_evolution_check(board, promotion.__name__.lower())
+    return player_move_completed
+
+
 def letter_to_num(letter):
     """
     Input: string - lower case letter in the english alphabet\n
@@ -839,13 +2912,266 @@ def convert_input_to_coords(player_input):
         return False
 
 
-def check_then_move(selected_position, destination_position, player):
+def convert_input_to_evolution(player_input):
+    """
+    Input: string - formatted as 'LetterNumber to LetterNumber', optionally followed by what a pawn becomes (i.e. a7 to a8 knight)\n
+    Output: str - what a pawn reaching the other side becomes ("queen" if not given), False if it is not something a pawn can become
+    """
+    split_text = player_input.split()
+    if len(split_text) <= 3:
+        return "queen"
+    evolution = split_text[3].lower()
+    if evolution not in PROMOTION_NAMES:
+        return False
+    return evolution
+
+
+def coords_to_input(coordinates):
+    """
+    Input: tuple pair of two ints\n
+    Output: string - the space the way players type it (i.e. (1, 0) is 'a2')\n
+    Reverse of the conversion in convert_input_to_coords()
+    """
+    return 'abcdefgh'[coordinates[1]] + str(coordinates[0] + 1)
+
+
+def square_name(coordinates):
     """
-    Inputs: coordinates, coordinates, string == 'white' or 'black'\n
+    Input: tuple pair of two ints\n
+    Output: string - the space the way PGN and FEN name it (row 0 is rank 8, i.e. (7, 0) is 'a1')
+    """
+    return 'abcdefgh'[coordinates[1]] + str(8 - coordinates[0])
+
+
+def move_to_san(board, selected_position, destination_position, promotion=None):
+    """
+    Inputs: Board object before the move, coordinates, coordinates, optional Piece class a pawn becomes\n
+    Output: string - the move in standard algebraic notation (i.e. 'Nxe5+')
+    """
+    piece = board.coords_to_piece(selected_position)
+    capture = is_space_occupied(board, destination_position)
+
+    if isinstance(piece, Pawn):
+        san = ''
+        if capture:
+            san = 'abcdefgh'[selected_position[1]] + 'x'
+        san += square_name(destination_position)
+        if promotion:
+            san += '=' + FEN_LETTERS[promotion].upper()
+    else:
+        # Name the column, row or both of the piece when another piece of the same type can reach the space
+        rivals = [move[0] for move in all_legal_moves(board, piece.team) if move[1] == destination_position and
+                  move[0] != selected_position and type(board.coords_to_piece(move[0])) is type(piece)]
+        disambiguation = ''
+        if rivals:
+            if all(rival[1] != selected_position[1] for rival in rivals):
+                disambiguation = 'abcdefgh'[selected_position[1]]
+            elif all(rival[0] != selected_position[0] for rival in rivals):
+                disambiguation = str(8 - selected_position[0])
+            else:
+                disambiguation = square_name(selected_position)
+        san = FEN_LETTERS[type(piece)].upper() + disambiguation + ('x' if capture else '') + square_name(destination_position)
+
+    undo = board.make_move(selected_position, destination_position, promotion)
+    opposite_team = other_team(piece.team)
+    pins_and_checks = find_pins_and_checks(board, opposite_team)
+    if pins_and_checks and pins_and_checks[1]:
+        if generate_move_codes(board, opposite_team):
+            san += '+'
+        else:
+            san += '#'
+    board.unmake_move(undo)
+    return san
+
+
+def san_to_move(board, team, san):
+    """
+    Inputs: Board object, str == "white" or "black", string - a move in standard algebraic notation\n
+    Output: (selected position, destination position, str - what a pawn becomes or None), or None if the move
+            is not legal or can not be read
+    """
+    match = SAN_PATTERN.match(san.rstrip('+#!?'))
+    if not match:
+        return None
+    letter, from_column, from_row, destination, promotion_letter = match.groups()
+    piece_type = FEN_PIECES[(letter or 'p').lower()]
+    destination_position = (8 - int(destination[1]), 'abcdefgh'.index(destination[0]))
+
+    candidates = []
+    for selected_position, moves in legal_moves_by_piece(board, team).items():
+        if destination_position not in moves or type(board.coords_to_piece(selected_position)) is not piece_type:
+            continue
+        if from_column and 'abcdefgh'[selected_position[1]] != from_column:
+            continue
+        if from_row and str(8 - selected_position[0]) != from_row:
+            continue
+        candidates.append(selected_position)
+    if len(candidates) != 1:
+        return None
+
+    evolution = None
+    if piece_type is Pawn and destination_position[0] in (0, 7):
+        if not promotion_letter:
+            return None
+        evolution = FEN_PIECES[promotion_letter.lower()].__name__.lower()
+    elif promotion_letter:
+        return None
+    return candidates[0], destination_position, evolution
+
+
+def game_to_pgn(board, result='*', tags=None):
+    """
+    Inputs: Board object, optional str - '1-0', '0-1', '1/2-1/2' or '*', optional dict of extra PGN tags\n
+    Output: string - the board's move history as a PGN game\n
+    The starting board of this game is not the standard one, so the FEN tag is always written
+    """
+    start_fen = board.start_fen or board.to_fen()
+    pgn_tags = {'Event': '?', 'Site': '?', 'Date': time.strftime('%Y.%m.%d'), 'Round': '?',
+                'White': '?', 'Black': '?', 'Result': result}
+    pgn_tags.update(tags or {})
+    pgn_tags['SetUp'] = '1'
+    pgn_tags['FEN'] = start_fen
+
+    replay_board = Board()
+    replay_board.load_fen(start_fen)
+    tokens = []
+    for selected_position, destination_position, promotion in board.move_history:
+        if replay_board.turn == 'white':
+            tokens.append(f'{replay_board.fullmove_number}.')
+        elif not tokens:
+            tokens.append(f'{replay_board.fullmove_number}...')
+        tokens.append(move_to_san(replay_board, selected_position, destination_position, promotion))
+        replay_board.count_move(replay_board.turn, True)
+        replay_board.make_move(selected_position, destination_position, promotion)
+    tokens.append(result)
+
+    # Movetext lines are kept under 80 characters
+    lines = []
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 79:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+
+    tag_lines = [f'[{name} "{value}"]' for name, value in pgn_tags.items()]
+    return '\n'.join(tag_lines) + '\n\n' + '\n'.join(lines) + '\n'
+
+
+def read_pgn_games(lines):
+    """
+    Input: iterable of strings (i.e. an open PGN file)\n
+    Output: generator of (dict of tags, list of SAN moves, str - result) for each game\n
+    Reads one game at a time, so files of any size are read in constant memory.
+    Comments, variations, move numbers and annotation glyphs are skipped
+    """
+    tags = {}
+    moves = []
+    comment_depth = 0
+    variation_depth = 0
+    for line in lines:
+        line = line.strip()
+        if comment_depth == 0 and variation_depth == 0:
+            if line.startswith('%'):
+                continue
+            tag = PGN_TAG_PATTERN.match(line)
+            if tag:
+                if moves:
+                    yield tags, moves, '*'
+                    tags, moves = {}, []
+                tags[tag.group(1)] = tag.group(2)
+                continue
+
+        for token in PGN_TOKEN_PATTERN.findall(line):
+            if comment_depth:
+                if token == '}':
+                    comment_depth = 0
+                continue
+            if token == '{':
+                comment_depth = 1
+            elif token == ';':
+                break
+            elif token == '(':
+                variation_depth += 1
+            elif token == ')':
+                variation_depth = max(variation_depth - 1, 0)
+            elif variation_depth or token[0] == '$' or token[0].isdigit() and token.rstrip('.').isdigit():
+                continue
+            elif token in PGN_RESULTS:
+                yield tags, moves, token
+                tags, moves = {}, []
+            else:
+                moves.append(token)
+
+    if moves or tags:
+        yield tags, moves, '*'
+
+
+def replay_pgn_games(lines):
+    """
+    Input: iterable of strings (i.e. an open PGN file)\n
+    Output: generator of (dict of tags, int - moves replayed, str - why the game is invalid or None) for each game\n
+    Plays every game from read_pgn_games() through check_then_move() on one board. Games without a FEN tag
+    start from this game's starting board. A bad FEN or move is reported for its own game and the next game carries on
+    """
+    board = Board()
+    for tags, moves, result in read_pgn_games(lines):
+        error = None
+        moves_replayed = 0
+        try:
+            if 'FEN' in tags:
+                board.load_fen(tags['FEN'])
+            else:
+                initialize_board(board)
+            for san in moves:
+                move = san_to_move(board, board.turn, san)
+                if move is None:
+                    error = f'illegal move {san} for {board.turn}'
+                    break
+                selected_position, destination_position, evolution = move
+                check_then_move(board, selected_position, destination_position, board.turn)
+                if evolution:
+                    board.coords_to_piece(destination_position).check_evolve(evolution)
+                moves_replayed += 1
+        except ValueError as bad_game:
+            # A bad game only invalidates itself; the next game sets the board up again
+            error = str(bad_game)
+        yield tags, moves_replayed, error
+
+
+def run_pgn_replay(path):
+    """
+    Input: str - path of a PGN file\n
+    Output: Boolean - True if every game was valid\n
+    Replays every game in the file and reports invalid games, games per second and moves per second
+    """
+    games = 0
+    invalid_games = 0
+    total_moves = 0
+    start_time = time.perf_counter()
+    with open(path, encoding='utf-8', errors='replace') as pgn_file:
+        for tags, moves_replayed, error in replay_pgn_games(pgn_file):
+            games += 1
+            total_moves += moves_replayed
+            if error:
+                invalid_games += 1
+                print(f'game {games} ({tags.get("White", "?")} - {tags.get("Black", "?")}): {error}')
+
+    elapsed = time.perf_counter() - start_time
+    print(f'{games} games ({invalid_games} invalid), {total_moves} moves in {elapsed:.3f}s '
+          f'({games / max(elapsed, 1e-9):.1f} games/s, {total_moves / max(elapsed, 1e-9):.0f} moves/s)')
+    return invalid_games == 0
+
+
+def check_then_move(board, selected_position, destination_position, player):
+    """
+    Inputs: Board object, coordinates, coordinates, string == 'white' or 'black'\n
     Output: Boolean\n
     This is the main function that handles all player movement
     """
-    selected_piece = THE_BOARD.coords_to_piece(selected_position)
+    selected_piece = board.coords_to_piece(selected_position)
     if not isinstance(selected_piece, Piece):
         print("space selected is empty")
         return False
@@ -853,179 +3179,867 @@ def check_then_move(selected_position, destination_position, player):
         print("selected piece is on the opposite team")
         return False
     else:
-        possible_moves = selected_piece.all_possible_moves()
+        # Only the selected piece's moves are needed, unless every piece's moves are already in the move cache
+        cached_moves = board.move_cache.get((board.hash, player))
+        if cached_moves is not None:
+            possible_moves = cached_moves[selected_position]
+        else:
+            possible_moves = selected_piece.all_possible_moves()
         if destination_position in possible_moves:
+            board.count_move(player, isinstance(selected_piece, Pawn) or is_space_occupied(board, destination_position))
+            board.record_move(selected_position, destination_position)
             old_position = selected_piece.position
             selected_piece.position = destination_position
-            THE_BOARD.positions[old_position[0]][old_position[1]] = ' '
-            THE_BOARD.update(selected_piece)
-            THE_BOARD.update_all_spaces_threatened()
+            board.clear(old_position)
+            board.update(selected_piece)
             selected_piece.has_moved = True
+            board.set_turn(other_team(player))
             return True
         else:
             print("invalid destination")
             return False
 
 
-def pawn_evolution_check():
+def check_then_move_batch(boards, moves):
     """
-    Checks to see if a pawn made it to the other side
+    Inputs: list of Board objects, list with one move per board. A move is (selected position, destination position)
+            or (selected position, destination position, str - what a pawn reaching the other side becomes)\n
+    Output: list with a dict per board: {'legal', 'check', 'checkmate', 'stalemate'} (all Booleans)\n
+    Batch version of check_then_move() for servers that step many games at once. Each move is made by the
+    team whose turn it is on its board. Legal moves are played, illegal ones (including a pawn becoming
+    something other than a knight, bishop, rook or queen) leave the board untouched.
+    Whether the next team is in check is worked out for all the boards together (with NumPy when it is installed),
+    then each board looks for a legal reply with Board.has_any_legal_move(), which stops at the first one it finds
+    """
+    results = []
+    moved_boards = []
+    for board, move in zip(boards, moves):
+        result = {'legal': False, 'check': False, 'checkmate': False, 'stalemate': False}
+        results.append(result)
+        selected_position, destination_position = move[0], move[1]
+        selected_piece = board.coords_to_piece(selected_position)
+        if not isinstance(selected_piece, Piece) or selected_piece.team != board.turn:
+            continue
+        # Only the selected piece's moves are needed, unless every piece's moves are already in the move cache
+        cached_moves = board.move_cache.get((board.hash, board.turn))
+        if cached_moves is not None:
+            possible_moves = cached_moves[selected_position]
+        else:
+            possible_moves = selected_piece.all_possible_moves()
+        if destination_position not in possible_moves:
+            continue
+
+        # A pawn can only become one of the promotion choices, anything else makes the move invalid
+        promotion = None
+        if isinstance(selected_piece, Pawn) and destination_position[0] in (0, 7):
+            evolution = move[2] if len(move) > 2 else "queen"
+            if evolution not in PROMOTION_NAMES:
+                continue
+            promotion = PROMOTION_NAMES[evolution]
+        board.count_move(board.turn, isinstance(selected_piece, Pawn) or is_space_occupied(board, destination_position))
+        board.record_move(selected_position, destination_position)
+        board.record_promotion(promotion)
+        board.make_move(selected_position, destination_position, promotion)
+        board.record_position()
+        result['legal'] = True
+        moved_boards.append((board, result))
+
+    in_check = kings_in_check([board for board, result in moved_boards])
+    for (board, result), check in zip(moved_boards, in_check):
+        result['check'] = check
+        if not board.has_any_legal_move(board.turn):
+            result['checkmate'] = check
+            result['stalemate'] = not check
+
+    return results
+
+
+def kings_in_check(boards):
+    """
+    Input: list of Board objects\n
+    Output: list of Booleans, True where the king of the team whose turn it is is in check\n
+    With NumPy the enemy attack maps of every board are built at once, one bit operation per direction
+    for the whole batch (Kogge-Stone fills for the rooks, bishops and queens)
+    """
+    if numpy is None or not boards:
+        in_check = []
+        for board in boards:
+            pins_and_checks = find_pins_and_checks(board, board.turn)
+            in_check.append(pins_and_checks is not None and len(pins_and_checks[1]) > 0)
+        return in_check
+
+    def stack(values):
+        return numpy.array(values, dtype=numpy.uint64)
+
+    enemies = [other_team(board.turn) for board in boards]
+    empty = stack([FULL_BITBOARD ^ board.occupied_spaces() for board in boards])
+    kings = stack([board.bitboards[(board.turn, King)] for board in boards])
+    straight = stack([board.pieces_of_type(enemy, Rook, Queen) for board, enemy in zip(boards, enemies)])
+    diagonal = stack([board.pieces_of_type(enemy, Bishop, Queen) for board, enemy in zip(boards, enemies)])
+    knights = stack([board.bitboards[(enemy, Knight)] for board, enemy in zip(boards, enemies)])
+    enemy_kings = stack([board.bitboards[(enemy, King)] for board, enemy in zip(boards, enemies)])
+    white_pawns = stack([board.bitboards[('white', Pawn)] if enemy == 'white' else 0 for board, enemy in zip(boards, enemies)])
+    black_pawns = stack([board.bitboards[('black', Pawn)] if enemy == 'black' else 0 for board, enemy in zip(boards, enemies)])
+
+    attacks = numpy.zeros(len(boards), dtype=numpy.uint64)
+    for direction in STRAIGHT_DIRECTIONS:
+        attacks |= batch_sliding_attacks(straight, empty, direction)
+    for direction in DIAGONAL_DIRECTIONS:
+        attacks |= batch_sliding_attacks(diagonal, empty, direction)
+    for jump in KNIGHT_JUMPS:
+        attacks |= batch_shift(knights, jump)
+    for step in STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS:
+        attacks |= batch_shift(enemy_kings, step)
+    for step in ((-1, -1), (-1, 1)):
+        attacks |= batch_shift(white_pawns, step)
+    for step in ((1, -1), (1, 1)):
+        attacks |= batch_shift(black_pawns, step)
+
+    return [bool(check) for check in (attacks & kings) != 0]
+
+
+def batch_shift(bitboards, step):
+    """
+    Inputs: NumPy array of bitboards, (row, column) step\n
+    Output: NumPy array with every set space moved by the step. Spaces that would leave the board are dropped
     """
-    for x in range(len(THE_BOARD.positions)):
-        for y in range(len(THE_BOARD.positions[x])):
-            selected_piece = THE_BOARD.positions[x][y]
+    shift = step[0] * 8 + step[1]
+    if shift > 0:
+        moved = bitboards << numpy.uint64(shift)
+    else:
+        moved = bitboards >> numpy.uint64(-shift)
+    return moved & numpy.uint64(COLUMN_WRAP_MASKS[step[1]])
+
+
+def batch_sliding_attacks(sliders, empty, direction):
+    """
+    Inputs: NumPy array of bitboards of rooks/bishops/queens, NumPy array of bitboards of empty spaces, (row, column) direction\n
+    Output: NumPy array of the spaces attacked along the direction, up to and including the first blocker\n
+    Kogge-Stone fill: the sliders spread over empty spaces 1, then 2, then 4 steps at a time
+    """
+    empty = empty & numpy.uint64(COLUMN_WRAP_MASKS[direction[1]])
+    for steps in (1, 2, 4):
+        step = (direction[0] * steps, direction[1] * steps)
+        shift = step[0] * 8 + step[1]
+        if shift > 0:
+            sliders = sliders | (empty & (sliders << numpy.uint64(shift)))
+            empty = empty & (empty << numpy.uint64(shift))
+        else:
+            sliders = sliders | (empty & (sliders >> numpy.uint64(-shift)))
+            empty = empty & (empty >> numpy.uint64(-shift))
+    return batch_shift(sliders, direction)
+
 
+def pawn_evolution_check(board, evolution=None):
+    """
+    Inputs: Board object, optional str - what the pawn becomes, the player is asked if not given\n
+    Checks to see if a pawn made it to the other side
+    """
+    # Pawns that evolve leave the board's piece lists, which is fine since piece_list_of_types() builds a new list
+    for team in ('white', 'black'):
+        for selected_piece in board.piece_list_of_types(team, Pawn):
             # Check if pawn made it to opposite side
-            if isinstance(selected_piece, Pawn):
-                selected_piece.check_evolve()
+            selected_piece.check_evolve(evolution)
 
 
-def is_my_king_in_check(player):
+def is_my_king_in_check(board, player):
     """
-    Input: str == "white" or "black"\n
+    Input: Board object, str == "white" or "black"\n
     Output: King object or False\n
     """
-    for x in range(len(THE_BOARD.positions)):
-        for y in range(len(THE_BOARD.positions[x])):
-            selected_piece = THE_BOARD.positions[x][y]
+    # The board knows where the king is, so only the spaces that could threaten it are looked at
+    king_position = board.king_positions[player]
+    if king_position is None:
+        return False
+    if board.is_square_attacked(coords_to_square(king_position), other_team(player)):
+        return board.coords_to_piece(king_position)
+    return False
+
+
+def legal_moves_by_piece(board, team, pins_and_checks=False):
+    """
+    Inputs: Board object, str == "white" or "black", optional output of find_pins_and_checks() for the team
+            to share between the pieces instead of each piece working it out\n
+    Output: dict of each of the team's piece positions to the list of spaces that piece can move to\n
+    Generates every piece's moves in one pass and keeps them in the board's move cache, so the checks made
+    on one turn (check, checkmate, stalemate and the move itself) share the work. The cache is keyed by the
+    position's hash, which changes with every change to the board, so old results are never used for a new
+    position. Do not change the lists that are returned
+    """
+    key = (board.hash, team)
+    if key in board.move_cache:
+        board.move_cache.move_to_end(key)
+        return board.move_cache[key]
+
+    legal_moves = {}
+    for piece in board.all_pieces_on_team(team):
+        if pins_and_checks is False:
+            legal_moves[piece.position] = piece.all_possible_moves()
+        else:
+            legal_moves[piece.position] = list(piece.iter_possible_moves(pins_and_checks))
+
+    board.move_cache[key] = legal_moves
+    if len(board.move_cache) > MOVE_CACHE_SIZE:
+        board.move_cache.popitem(last=False)
+    return legal_moves
+
+
+class Instrumentation():
+    "Opt-in call counts, times and latency histograms for the hot paths, dumped as JSON"
+
+    def __init__(self, path=None, interval=10.0):
+        # File the stats are written to, and seconds between writes (they are written after a turn once it is time)
+        self.path = path
+        self.interval = interval
+        self.last_dump = time.perf_counter()
+        self.started = time.perf_counter()
+
+        # Per name: number of calls, total nanoseconds, slowest call and calls per power of two nanoseconds
+        self.calls = {}
+        self.total_time = {}
+        self.slowest = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+        # (owner, attribute, original) of everything wrapped, so disable() can put it back
+        self.wrapped = []
+
+    def enable(self):
+        """
+        Wraps the functions in INSTRUMENTED_FUNCTIONS with timers. Nothing is wrapped, so nothing costs anything,
+        until this is called
+        """
+        if self.wrapped:
+            return
+        module = sys.modules[__name__]
+        for owner_name, attribute, name, per_turn in INSTRUMENTED_FUNCTIONS:
+            owner = module if owner_name is None else getattr(module, owner_name)
+            original = owner.__dict__[attribute]
+            setattr(owner, attribute, self.timed(original, name, per_turn))
+            self.wrapped.append((owner, attribute, original))
+
+    def disable(self):
+        """
+        Puts the original functions back
+        """
+        for owner, attribute, original in reversed(self.wrapped):
+            setattr(owner, attribute, original)
+        self.wrapped = []
+
+    def timed(self, function, name, per_turn):
+        """
+        Inputs: function, str - name in the stats, Boolean - True if it runs once per turn\n
+        Output: function that calls the original and records how long it took
+        """
+        instrumentation = self
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start_time = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                instrumentation.record(name, time.perf_counter_ns() - start_time)
+                if per_turn:
+                    instrumentation.dump_if_due()
+        return timed_function
+
+    def record(self, name, elapsed):
+        """
+        Inputs: str - name in the stats, int - nanoseconds a call took\n
+        Counts the call and adds it to the name's histogram
+        """
+        bucket = max(elapsed.bit_length() - 1, 0)
+        with self.lock:
+            if name not in self.calls:
+                self.calls[name] = 0
+                self.total_time[name] = 0
+                self.slowest[name] = 0
+                self.histograms[name] = [0] * 64
+            self.calls[name] += 1
+            self.total_time[name] += elapsed
+            self.slowest[name] = max(self.slowest[name], elapsed)
+            self.histograms[name][bucket] += 1
+
+    def percentile(self, name, fraction):
+        """
+        Inputs: str - name in the stats, float between 0 and 1\n
+        Output: float - microseconds that fraction of the calls took at most (rounded up to a power of two nanoseconds)
+        """
+        needed = fraction * self.calls[name]
+        seen = 0
+        for bucket, count in enumerate(self.histograms[name]):
+            seen += count
+            if count and seen >= needed:
+                return min(2 ** (bucket + 1), self.slowest[name]) / 1000
+        return self.slowest[name] / 1000
+
+    def stats(self):
+        """
+        Output: dict of the stats so far, ready for json
+        """
+        with self.lock:
+            functions = {}
+            for name in sorted(self.calls):
+                calls = self.calls[name]
+                functions[name] = {
+                    'calls': calls,
+                    'total_ms': round(self.total_time[name] / 1e6, 3),
+                    'mean_us': round(self.total_time[name] / calls / 1000, 3),
+                    'p50_us': self.percentile(name, 0.5),
+                    'p90_us': self.percentile(name, 0.9),
+                    'p99_us': self.percentile(name, 0.99),
+                    'max_us': self.slowest[name] / 1000,
+                    'histogram_ns': {f'<{2 ** (bucket + 1)}': count for bucket, count in enumerate(self.histograms[name]) if count},
+                }
+        return {'time': time.time(), 'uptime_s': round(time.perf_counter() - self.started, 3), 'functions': functions}
+
+    def dump(self):
+        """
+        Writes the stats to the file (or prints them if there is no file)
+        """
+        self.last_dump = time.perf_counter()
+        text = json.dumps(self.stats(), indent=2)
+        if self.path is None:
+            print(text)
+            return
+        # Written next to the file then moved over it, so readers never see half a dump
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as stats_file:
+            stats_file.write(text)
+        os.replace(temporary_path, self.path)
+
+    def dump_if_due(self):
+        """
+        Writes the stats if the interval has passed since the last time
+        """
+        if time.perf_counter() - self.last_dump >= self.interval:
+            self.dump()
+
 
-            # Check if king is in check and if it is checkmate
-            if isinstance(selected_piece, King):
-                if selected_piece.team == "white":
-                    opposite_team = "black"
+class TerminalDisplay():
+    "Draws the board in place in an ANSI terminal, rewriting only the spaces that changed since the last frame"
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+        # Board.squares of the frame on screen, None until the first frame is drawn
+        self.last_squares = None
+
+        # Colored glyph for each code in Board.squares, made the first time the code is drawn
+        self.glyphs = {0: '  '}
+
+    def glyph(self, piece):
+        """
+        Input: Piece object\n
+        Output: string - the piece's symbol in its team's color, followed by a space
+        """
+        code = PIECE_CODES[type(piece)] | TEAM_CODES[piece.team]
+        if code not in self.glyphs:
+            if piece.team == 'white':
+                self.glyphs[code] = stylize(piece.symbol+' ', colored.fg("light_blue"))
+            else:
+                self.glyphs[code] = stylize(piece.symbol+' ', colored.fg("light_red"))
+        return self.glyphs[code]
+
+    def draw(self, board):
+        """
+        Input: Board object\n
+        Draws the board with one write. The first frame clears the screen, draws the whole board at the top and keeps the
+        rest of the screen scrolling below it. Later frames only move the cursor to each changed space and redraw it
+        """
+        parts = []
+        if self.last_squares is None:
+            parts.append('\x1b[2J\x1b[H')
+            parts.append(board.to_text())
+            # Everything printed after the board scrolls below it, so the board never moves
+            top = BOARD_TEXT_LINES + 2
+            parts.append(f'\x1b[{top};{shutil.get_terminal_size().lines}r\x1b[{top};1H')
+        else:
+            # Save the cursor, redraw the spaces, put the cursor back
+            parts.append('\x1b7')
+            for square in range(64):
+                if board.squares[square] != self.last_squares[square]:
+                    row, column = SQUARE_COORDS[square]
+                    piece = board.positions[row][column]
+                    glyph = self.glyphs[0] if isinstance(piece, str) else self.glyph(piece)
+                    parts.append(f'\x1b[{2 + 2 * row};{6 + 4 * column}H{glyph}')
+            parts.append('\x1b8')
+        self.last_squares = bytes(board.squares)
+
+        self.stream.write(''.join(parts))
+        self.stream.flush()
+
+    def close(self):
+        """
+        Lets the whole screen scroll again
+        """
+        if self.last_squares is not None:
+            self.stream.write(f'\x1b[r\x1b[{shutil.get_terminal_size().lines};1H\n')
+            self.stream.flush()
+            self.last_squares = None
+
+
+def show_board(board, screen=None):
+    """
+    Inputs: Board object, optional TerminalDisplay\n
+    Shows the board with the TerminalDisplay if there is one, otherwise prints it all with Board.display()
+    """
+    if screen:
+        screen.draw(board)
+    else:
+        board.display()
+
+
+def open_screen(display_mode):
+    """
+    Input: str == "full" or "diff"\n
+    Output: TerminalDisplay for "diff" when the output is a terminal big enough for it, otherwise None (full reprints)
+    """
+    if display_mode == "diff" and sys.stdout.isatty() and shutil.get_terminal_size().lines >= BOARD_TEXT_LINES + 8:
+        return TerminalDisplay()
+    return None
+
+
+class GameSession():
+    "One game played over a connection to the GameServer"
+
+    def __init__(self, computer_team=None):
+        self.board = Board()
+        self.computer_team = computer_team
+        self.new_game()
+
+    def new_game(self):
+        """
+        Output: list of strings - lines to send to the player\n
+        Sets the board up for a new game
+        """
+        initialize_board(self.board)
+        self.result = None
+        return [self.board.to_text(colors=False)] + self.status()
+
+    def play_input(self, player_input):
+        """
+        Input: string - formatted as 'LetterNumber to LetterNumber', optionally followed by what a pawn becomes (i.e. a7 to a8 knight)\n
+        Output: list of strings - lines to send to the player
+        """
+        if self.result:
+            return [f"GAME OVER: {self.result}. Send 'new' to play again"]
+        coordinates = convert_input_to_coords(player_input)
+        if not coordinates:
+            return ["ERROR moves look like: a2 to a4"]
+        evolution = convert_input_to_evolution(player_input)
+        if not evolution:
+            return ["ERROR a pawn can become a knight, bishop, rook or queen"]
+        return self.play_move(coordinates[0], coordinates[1], evolution)
+
+    def play_move(self, selected_position, destination_position, evolution="queen"):
+        """
+        Inputs: coordinates, coordinates, optional str - what a pawn reaching the other side becomes\n
+        Output: list of strings - lines to send to the player\n
+        Plays a move for the team whose turn it is through check_then_move()
+        """
+        board = self.board
+        player = board.turn
+        selected_piece = board.coords_to_piece(selected_position)
+        if not isinstance(selected_piece, Piece):
+            return ["ERROR space selected is empty"]
+        if selected_piece.team != player:
+            return ["ERROR selected piece is on the opposite team"]
+        if destination_position not in legal_moves_by_piece(board, player)[selected_position]:
+            return ["ERROR invalid destination"]
+
+        check_then_move(board, selected_position, destination_position, player)
+        moved_piece = board.coords_to_piece(destination_position)
+        if isinstance(moved_piece, Pawn):
+            moved_piece.check_evolve(evolution)
+
+        move = f"{TEAM_COLORS[player].upper()} MOVES: {coords_to_input(selected_position)} to {coords_to_input(destination_position)}"
+        return [move, board.to_text(colors=False)] + self.status()
+
+    def status(self):
+        """
+        Output: list of strings - check, the end of the game or whose turn it is\n
+        Makes the same checks the game loop makes at the start of every turn
+        """
+        board = self.board
+        player = board.turn
+        player_color = TEAM_COLORS[player]
+        board.record_position()
+        if board.repetition_count() >= 3:
+            self.result = "THREEFOLD REPETITION. TIE GAME"
+            return [self.result]
+
+        lines = []
+        position = board.classify_position(player)
+        if position['check']:
+            lines.append(f"{player_color.upper()} KING IN CHECK")
+        if position['checkmate']:
+            self.result = f"CHECKMATE. {player_color.upper()} LOSES"
+        elif position['stalemate']:
+            self.result = "STALEMATE. TIE GAME"
+        elif position['insufficient_material']:
+            self.result = "INSUFFICIENT MATERIAL. TIE GAME"
+        else:
+            return lines + [f"{player_color.upper()} TO MOVE"]
+        return lines + [self.result]
+
+    def pgn(self):
+        """
+        Output: list of strings - the game so far as PGN
+        """
+        return [game_to_pgn(self.board).rstrip('\n')]
+
+    def computer_to_move(self):
+        """
+        Output: Boolean - True if it is the computer's turn in a game that is not over
+        """
+        return self.result is None and self.board.turn == self.computer_team
+
+
+class GameServer():
+    "asyncio server for many games at once over a line based TCP protocol"
+
+    def __init__(self, computer_team=None, time_limit=2.0, workers=None):
+        # Moves are checked and played in threads so a slow board never holds up the event loop,
+        # the computer thinks in other processes so it does not hold up the other games either
+        self.computer_team = computer_team
+        self.time_limit = time_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.engine_executor = None
+        if computer_team:
+            self.engine_executor = ProcessPoolExecutor(max_workers=workers)
+        self.server = None
+
+        # Writer of every open connection, keyed by the task handling it
+        self.connections = {}
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """
+        Inputs: optional str - address to listen on, optional int - port to listen on (0 picks a free one)\n
+        Output: int - the port the server listens on
+        """
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stops listening, ends the open games and shuts the executors down
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.connections.values()):
+            writer.close()
+        if self.connections:
+            await asyncio.gather(*self.connections, return_exceptions=True)
+        self.executor.shutdown()
+        if self.engine_executor is not None:
+            self.engine_executor.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Inputs: asyncio StreamReader and StreamWriter of a player's connection\n
+        Plays one game session per connection. Every reply is a block of lines ending with a line that is just '.'
+        """
+        loop = asyncio.get_running_loop()
+        self.connections[asyncio.current_task()] = writer
+        session = GameSession(self.computer_team)
+        reply = ["Welcome to Chess! State your moves in the form: a2 to a4",
+                 "Other commands: board, fen, pgn, new, quit"] + session.new_game()
+        try:
+            while True:
+                while session.computer_to_move():
+                    reply += await self.play_computer_move(session)
+                await send_lines(writer, reply)
+
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                if command == "quit":
+                    break
+                elif command == "board":
+                    reply = [session.board.to_text(colors=False)]
+                elif command == "fen":
+                    reply = [session.board.to_fen()]
+                elif command == "pgn":
+                    # Writing the PGN replays the whole game, so it is done off the event loop like a move
+                    reply = await loop.run_in_executor(self.executor, session.pgn)
+                elif command == "new":
+                    reply = await loop.run_in_executor(self.executor, session.new_game)
                 else:
-                    opposite_team = "white"
+                    reply = await loop.run_in_executor(self.executor, session.play_input, command)
+        except ConnectionError:
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
-                # Make sure the king belongs to the inputted player
-                if selected_piece.team == player:
-                    # All threatened spaces do not include the spaces that are threatened by pieces on the same team
-                    spaces_threatened = THE_BOARD.spaces_threatened_by_team(opposite_team)
-        
-                    if (x, y) in spaces_threatened:
-                        king_in_check = selected_piece
-                        return king_in_check
-    
-    return False
+    async def play_computer_move(self, session):
+        """
+        Input: GameSession whose turn is the computer's\n
+        Output: list of strings - lines to send to the player
+        """
+        loop = asyncio.get_running_loop()
+        board = session.board
+        root_moves = await loop.run_in_executor(self.executor, generate_move_codes, board, board.turn)
+        _, code, _, _, _ = await loop.run_in_executor(self.engine_executor, search_root_moves, board, board.turn, root_moves,
+                                                      self.time_limit, None, 64, 16)
+        selected_position, destination_position, promotion = decode_move(code)
+        evolution = promotion.__name__.lower() if promotion else "queen"
+        return await loop.run_in_executor(self.executor, session.play_move, selected_position, destination_position, evolution)
 
 
-def check_stalemate(player):
+async def send_lines(writer, lines):
     """
-    Input: str == "white" or "black"\n
-    Output: Boolean\n
-    Check's all the possible moves a player has; if there are none; return True
+    Inputs: asyncio StreamWriter, list of strings\n
+    Sends the lines followed by the line '.' that ends the reply
     """
-    pieces = THE_BOARD.all_pieces_on_team(player)
-    for piece in pieces:
-        if len(piece.all_possible_moves()) > 0:
-            return False
-    return True
+    writer.write(('\n'.join(lines) + '\n.\n').encode())
+    await writer.drain()
 
 
-def update_threatening_king(piece):
+async def read_reply(reader):
     """
-    Input: Piece object\n
-    Helper function to be used by every piece when determining the spaces they threaten
+    Input: asyncio StreamReader\n
+    Output: list of strings - the lines of one reply from the GameServer
     """
-    if piece.team == 'white':
-        opposite_team = 'black'
-    else:
-        opposite_team = 'white'
+    lines = []
+    while True:
+        line = await reader.readline()
+        if not line or line == b'.\n':
+            return lines
+        lines.append(line.decode().rstrip('\n'))
 
-    for space in piece.spaces_threatened:
-        if is_within_bounds(space):
-            selected_piece = THE_BOARD.coords_to_piece(space)
-            if isinstance(selected_piece, King):
-                # This piece of code isn't needed because when determining possible moves/threats,
-                # Spaces containing pieces on the same team are not added to the list
-                if selected_piece.team == opposite_team:
-                    piece.threatening_king = True
-                    return None
 
-            piece.threatening_king = False
+async def loopback_client(port, player_inputs, host='127.0.0.1'):
+    """
+    Inputs: int - port of a GameServer, list of strings - what the player types, optional str - address of the server\n
+    Output: list of replies (each a list of strings), the greeting first\n
+    Stands in for a player: sends every input, waits for each reply, then quits
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    replies = [await read_reply(reader)]
+    for player_input in player_inputs:
+        writer.write((player_input + '\n').encode())
+        await writer.drain()
+        replies.append(await read_reply(reader))
+    writer.write(b'quit\n')
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+    return replies
+
+
+def run_loopback_games(game_count):
+    """
+    Input: int - number of games\n
+    Output: Boolean - True if every game ended in checkmate\n
+    Starts a GameServer on a free port and has that many loopback clients play the quickest checkmate at the same time
+    """
+    async def play_games():
+        server = GameServer()
+        port = await server.start(port=0)
+        start_time = time.perf_counter()
+        games = await asyncio.gather(*[loopback_client(port, LOOPBACK_GAME) for _ in range(game_count)])
+        elapsed = time.perf_counter() - start_time
+        await server.close()
+        return games, elapsed
+
+    games, elapsed = asyncio.run(play_games())
+    checkmates = sum(1 for replies in games if "CHECKMATE. BLUE LOSES" in replies[-1])
+    print(f"{checkmates}/{game_count} games ended in checkmate in {elapsed:.3f}s ({game_count / max(elapsed, 1e-9):.1f} games/s)")
+    return checkmates == game_count
+
+
+def run_server(host, port, computer_team=None, time_limit=2.0, workers=None):
+    """
+    Inputs: str - address to listen on, int - port, optional str == "white" or "black" - the team the computer plays
+            in every game, optional float - seconds the computer thinks per move, optional int - worker threads and processes\n
+    Serves games until interrupted
+    """
+    async def serve():
+        server = GameServer(computer_team, time_limit, workers)
+        listening_port = await server.start(host, port)
+        print(f"Serving chess on {host}:{listening_port}")
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
 
 
-def count_possible_moves_when_in_check(king_in_check):
+def read_script_games(lines):
     """
-    Input: King object\n
-    Output: Number of possible moves (int)\n
-    This function counts the number of moves possible when a king is in check.\n
-    FUTURE USE: It also keeps track of those moves by saving a list of possible destinations 
-    for each piece that can make a move in piece.possible_moves_during_check
+    Input: iterable of strings (i.e. an open file or sys.stdin)\n
+    Output: generator of lists of strings - the moves of each game\n
+    A move script has one move per line in the form the players type. Games are separated by blank lines
+    and lines starting with # are left out
+    """
+    moves = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line:
+            moves.append(line)
+        elif moves:
+            yield moves
+            moves = []
+
+    if moves:
+        yield moves
+
+
+def play_scripted_game(board, player_inputs, report=None):
+    """
+    Inputs: Board object, list of strings - formatted as 'LetterNumber to LetterNumber', optionally followed by what
+            a pawn becomes (i.e. a7 to a8 knight), optional function that is handed a dict for every move\n
+    Output: dict - 'result' ('1-0', '0-1', '1/2-1/2' or '*' if the moves ran out first), 'reason' (checkmate,
+            stalemate, repetition, insufficient material or None), 'plies' played and 'error' (None if every move was played)\n
+    Plays the moves from the starting board through check_then_move() without drawing the board or asking for anything,
+    and makes the same end of game checks as the game loop after every move. Stops at the first move that cannot be played
+    """
+    initialize_board(board)
+    board.record_position()
+    result = '*'
+    reason = None
+    error = None
+    plies = 0
+
+    for player_input in player_inputs:
+        player = board.turn
+        if reason:
+            error = f"{player_input}: the game is already over"
+        else:
+            coordinates = convert_input_to_coords(player_input)
+            evolution = convert_input_to_evolution(player_input)
+            if not coordinates or not evolution:
+                error = f"{player_input}: moves look like a2 to a4, or a7 to a8 knight for a pawn"
+            elif not check_then_move(board, coordinates[0], coordinates[1], player):
+                error = f"{player_input}: not a legal move for {TEAM_COLORS[player]}"
+        if error:
+            if report:
+                report({'ply': plies + 1, 'move': player_input, 'status': 'error', 'error': error})
+            break
+
+        moved_piece = board.coords_to_piece(coordinates[1])
+        if isinstance(moved_piece, Pawn):
+            moved_piece.check_evolve(evolution)
+        plies += 1
+
+        # The checks the game loop makes at the start of the next turn
+        next_player = board.turn
+        board.record_position()
+        position = board.classify_position(next_player)
+        if board.repetition_count() >= 3:
+            result, reason = '1/2-1/2', 'repetition'
+        elif position['checkmate']:
+            result, reason = ('1-0' if next_player == 'black' else '0-1'), 'checkmate'
+        elif position['stalemate']:
+            result, reason = '1/2-1/2', 'stalemate'
+        elif position['insufficient_material']:
+            result, reason = '1/2-1/2', 'insufficient material'
+        if report:
+            report({'ply': plies, 'move': player_input, 'status': reason or ('check' if position['check'] else 'ok')})
+
+    return {'result': result, 'reason': reason, 'plies': plies, 'error': error}
+
+
+def run_script(path, per_move=False):
+    """
+    Inputs: str - path of a move script (see read_script_games()) or '-' for standard input,
+            optional Boolean - also write a line for every move\n
+    Output: Boolean - True if every move of every game was played\n
+    Plays every game in the script with play_scripted_game() and writes one JSON line per game with its result
+    and final FEN, after a JSON line per move when per_move is set
     """
-    num_of_possible_moves = 0
+    output = sys.stdout
 
-    if king_in_check.team == "white":
-        opposite_team = "black"
-    else:
-        opposite_team = "white"
-
-    # King moves out of check
-    king_in_check.possible_moves_during_check = king_in_check.all_possible_moves()
-
-    # Remove or block the piece placing you in check (If piece > 1, king has to move)
-    pieces_threatening_king = [i for i in THE_BOARD.all_pieces_on_team(opposite_team) if i.threatening_king]
-    for threat in pieces_threatening_king:
-        print(f'{threat.symbol}: threatening the king\n')
-
-    if len(pieces_threatening_king) == 1:
-        # Identify the piece that is threatening the king and all the space it is influencing
-        threat = pieces_threatening_king[0]
-        threat_space = threat.position
-
-        # Update the possible moves of the king's allies in this instance of check
-        possible_saviors = THE_BOARD.all_pieces_on_team(king_in_check.team)
-        possible_saviors.remove(king_in_check)
-
-        # The king might be the final piece remaining
-        if possible_saviors:
-            # Reset the possible moves that could have existed during the last check
-            for piece in possible_saviors:
-                piece.possible_moves_during_check = []
-
-            # If the threat is a knight or pawn, they do not have a 'path' they follow; they cannot be blocked
-            if isinstance(threat, Pawn) or isinstance(threat, Knight):
-                for piece in possible_saviors:
-                    if threat_space in piece.all_possible_moves():
-                        piece.possible_moves_during_check.append(threat_space)
-                        num_of_possible_moves += 1
-                    
-                    """
-                    # Debugging
-                    if piece.possible_moves_during_check:
-                        print(f"Potential Move: {piece.symbol}  on {piece.position} can move to {piece.possible_moves_during_check}")
-                    """
-            
-            # If the threat is a bishop or rook or queen, they have a blockable 'path' that can be occupied
-            elif isinstance(threat, Queen) or isinstance(threat, Bishop) or isinstance(threat, Rook):
-                path = threat.spaces_threatened_towards_king(threat.all_possible_moves(list_of_directional_threats=True))
-                path.append(threat_space)
-                for piece in possible_saviors:
-                    for space in path:
-                        if space in piece.all_possible_moves():
-                            piece.possible_moves_during_check.append(space)
-                            num_of_possible_moves += 1
-
-                    """
-                    # Debugging
-                    if piece.possible_moves_during_check:
-                        print(f"Potential Move: {piece.symbol}  on {piece.position} can move to {piece.possible_moves_during_check}")
-                    """
-        
-    # Return the number of possible moves
-    num_of_possible_moves += len(king_in_check.possible_moves_during_check)
+    def report(game_number, status):
+        output.write(json.dumps({'game': game_number, **status}) + '\n')
 
+    board = Board()
+    failed_games = 0
+    script = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        # The functions that check the moves print what is wrong with them for the players. Here the
+        # errors are in the JSON lines instead, and print() does nothing while sys.stdout is None
+        with contextlib.redirect_stdout(None):
+            for game_number, player_inputs in enumerate(read_script_games(script), 1):
+                per_move_report = functools.partial(report, game_number) if per_move else None
+                outcome = play_scripted_game(board, player_inputs, per_move_report)
+                outcome['fen'] = board.to_fen()
+                report(game_number, outcome)
+                if outcome['error']:
+                    failed_games += 1
+    finally:
+        if script is not sys.stdin:
+            script.close()
+    output.flush()
+    return failed_games == 0
+
+
+def ask_for_pawn_evolution(board):
     """
-    # Debugging
-    print("num moves possible:", num_of_possible_moves)
-    print("num moves king can do:", len(king_in_check.possible_moves_during_check))
-    print(king_in_check.possible_moves_during_check)
+    Input: Board object\n
+    Asks the player what a pawn that made it to the other side becomes until the answer is something it can become
+    """
+    while True:
+        try:
+            pawn_evolution_check(board)
+            return
+        except ValueError as error:
+            print(error)
+
+
+def main(computer_team=None, time_limit=2.0, workers=1, pgn_path=None, display_mode="full", book_path=None, tablebase_directory=None):
+    """
+    Inputs: optional str == "white" or "black" - the team the computer plays, optional float - seconds the computer thinks per move,
+            optional int - processes the computer searches with, optional str - file every finished game is added to as PGN,
+            optional str == "full" or "diff" - reprint the whole board every turn or redraw only the spaces that changed,
+            optional str - opening book the computer plays from, optional str - directory of tablebase files\n
+    Plays games until the players stop
     """
+    screen = open_screen(display_mode)
+    book = None
+    if computer_team and book_path:
+        book = OpeningBook(book_path)
+    tablebase = None
+    if tablebase_directory:
+        tablebase = Tablebase(tablebase_directory)
+    try:
+        while True:
+            play_game(computer_team, time_limit, workers, pgn_path, screen, book, tablebase)
+
+            again = input("Do you wanna play again?")
+            if not again.lower().startswith('y'):
+                print("Thanks for playing!")
+                break
+    finally:
+        if screen:
+            screen.close()
+        if book:
+            book.close()
+        if tablebase:
+            tablebase.close()
 
-    return num_of_possible_moves
- 
 
-def main():
-    "Runs the game loop"
+def play_game(computer_team=None, time_limit=2.0, workers=1, pgn_path=None, screen=None, book=None, tablebase=None):
+    """
+    Inputs: the same as main(), except for an optional TerminalDisplay to draw the board with instead of the display mode
+            and an optional OpeningBook and Tablebase instead of their paths\n
+    Runs the game loop for one game
+    """
     """
     # Debugging
     test_queen1 = Queen('white', (7, 0))
@@ -1035,21 +4049,27 @@ def main():
     test_king2 = King('white', (7, 4))
     test_pieces = [test_queen1, test_rook1, test_rook2, test_king1, test_king2]
     for test in test_pieces:
-        THE_BOARD.update(test)
-    for test in test_pieces:
-        test.update_spaces_threatened()
+        board.update(test)
     """
     
-    initialize_board()
+    board = Board()
+    initialize_board(board)
+
+    # The computer opponent, if there is one
+    engine = None
+    if computer_team:
+        engine = Engine(time_limit=time_limit, workers=workers, book=book, tablebase=tablebase)
 
     # Variable that keeps the game loop going
     game = True
     # Turn Counter
     turn = 0
     stalemate = False
+    repetition = False
+    insufficient_material = False
 
+    show_board(board, screen)
     print("Welcome to Chess! State your moves in the form: a2 to a4")
-    THE_BOARD.display()
 
     while game:
 
@@ -1057,17 +4077,28 @@ def main():
             player = "white"
             player_color = "blue"
             player_move_completed = False
-            my_king = is_my_king_in_check(player)
-            if my_king:
+            board.record_position()
+            if board.repetition_count() >= 3:
+                repetition = True
+                break
+            # Check, the end of the game and the legal moves all come from one pass over the position
+            position = board.classify_position(player)
+            if position['check']:
                 print(f"{player_color.upper()} KING IN CHECK")
-                if count_possible_moves_when_in_check(my_king) < 1:
+                for threat in position['checkers']:
+                    print(f'{threat.symbol}: threatening the king\n')
+                if position['checkmate']:
                     loser = player_color
                     break
-            
-            stalemate = check_stalemate(player)
-            if stalemate:
+
+            stalemate = position['stalemate']
+            insufficient_material = position['insufficient_material']
+            if stalemate or insufficient_material:
                 break
 
+            if player == computer_team:
+                player_move_completed = play_computer_move(board, engine, player, player_color)
+
             while not player_move_completed:
                 print("")
                 move = input("BLUE TO MOVE:\n")
@@ -1080,27 +4111,38 @@ def main():
 
                     # If the piece is succesfully moved, the player's turn is over
                     # Otherwise, completion remains False
-                    player_move_completed = check_then_move(selected_position, destination_position, player)
-                    pawn_evolution_check()
+                    player_move_completed = check_then_move(board, selected_position, destination_position, player)
+                    ask_for_pawn_evolution(board)
             
-            THE_BOARD.display()
+            show_board(board, screen)
             turn += 1
 
         else:
             player = "black"
             player_color = "red"
             player_move_completed = False
-            my_king = is_my_king_in_check(player)
-            if my_king:
+            board.record_position()
+            if board.repetition_count() >= 3:
+                repetition = True
+                break
+            # Check, the end of the game and the legal moves all come from one pass over the position
+            position = board.classify_position(player)
+            if position['check']:
                 print(f"{player_color.upper()} KING IN CHECK")
-                if count_possible_moves_when_in_check(my_king) < 1:
+                for threat in position['checkers']:
+                    print(f'{threat.symbol}: threatening the king\n')
+                if position['checkmate']:
                     loser = player_color
                     break
-            
-            stalemate = check_stalemate(player)
-            if stalemate:
+
+            stalemate = position['stalemate']
+            insufficient_material = position['insufficient_material']
+            if stalemate or insufficient_material:
                 break
 
+            if player == computer_team:
+                player_move_completed = play_computer_move(board, engine, player, player_color)
+
             while not player_move_completed:
                 move = input("RED TO MOVE:\n")
 
@@ -1112,23 +4154,377 @@ def main():
 
                     # If the piece is succesfully moved, the player's turn is over
                     # Otherwise, completion remains False
-                    player_move_completed = check_then_move(selected_position, destination_position, player)
-                    pawn_evolution_check()
+                    player_move_completed = check_then_move(board, selected_position, destination_position, player)
+                    ask_for_pawn_evolution(board)
             
-            THE_BOARD.display()
+            show_board(board, screen)
             turn += 1
 
     if stalemate:
         print(f"STALEMATE. TIE GAME")
+        result = '1/2-1/2'
+    elif repetition:
+        print(f"THREEFOLD REPETITION. TIE GAME")
+        result = '1/2-1/2'
+    elif insufficient_material:
+        print(f"INSUFFICIENT MATERIAL. TIE GAME")
+        result = '1/2-1/2'
     else:
         print(f"CHECKMATE. {loser.upper()} LOSES")
-
-    again = input("Do you wanna play again?")
-    if (again.lower())[0] == 'y':
-        main()
-    else:
-        print("Thanks for playing!")
+        result = '0-1' if loser == 'blue' else '1-0'
+
+    if pgn_path:
+        players = {'White': 'Computer' if computer_team == 'white' else 'Player',
+                   'Black': 'Computer' if computer_team == 'black' else 'Player'}
+        with open(pgn_path, 'a', encoding='utf-8') as pgn_file:
+            pgn_file.write(game_to_pgn(board, result, players) + '\n')
+        print(f"Game saved to {pgn_path}")
+
+    if engine:
+        engine.close()
+
+
+# Spaces of the same color as a1
+LIGHT_SPACES = sum(1 << light_square for light_square in range(64) if (light_square // 8 + light_square % 8) % 2 == 0)
+
+# Order Board.has_any_legal_move() tries each type of piece in: the moves of knights and pawns are the cheapest to find,
+# and in check the king is the piece most likely to have a move
+HAS_ANY_MOVE_ORDER = (Knight, Pawn, King, Bishop, Rook, Queen)
+HAS_ANY_MOVE_ORDER_IN_CHECK = (King, Knight, Pawn, Bishop, Rook, Queen)
+
+# Pieces a pawn can become when it reaches the other side
+PROMOTION_CHOICES = [Knight, Bishop, Rook, Queen]
+PROMOTION_NAMES = {"knight": Knight, "bishop": Bishop, "rook": Rook, "queen": Queen}
+
+# Spaces a bitboard shifted sideways by a column offset may land on. The rest wrapped around to another row
+COLUMN_WRAP_MASKS = {}
+for wrap_offset in (-2, -1, 0, 1, 2):
+    COLUMN_WRAP_MASKS[wrap_offset] = sum(1 << wrap_square for wrap_square in range(64) if 0 <= wrap_square % 8 - wrap_offset <= 7)
+
+# Letters used for each piece in FEN piece placements (upper case is white)
+FEN_PIECES = {'p': Pawn, 'r': Rook, 'n': Knight, 'b': Bishop, 'q': Queen, 'k': King}
+FEN_LETTERS = {piece_type: letter for letter, piece_type in FEN_PIECES.items()}
+FEN_SIDES = {'w': 'white', 'b': 'black'}
+
+# (class name or None for module functions, attribute, name in the stats, True if called once per turn) for Instrumentation
+INSTRUMENTED_FUNCTIONS = [
+    ('Board', 'classify_position', 'Board.classify_position', False),
+    (None, 'legal_moves_by_piece', 'legal_moves_by_piece', False),
+    (None, 'find_pins_and_checks', 'find_pins_and_checks', False),
+    ('Board', 'has_any_legal_move', 'Board.has_any_legal_move', False),
+    ('Piece', 'moves_ignoring_checks', 'Piece.moves_ignoring_checks', False),
+    ('Pawn', 'moves_ignoring_checks', 'Pawn.moves_ignoring_checks', False),
+    ('Pawn', 'all_possible_moves', 'Pawn.all_possible_moves', False),
+    ('Rook', 'all_possible_moves', 'Rook.all_possible_moves', False),
+    ('Knight', 'all_possible_moves', 'Knight.all_possible_moves', False),
+    ('Bishop', 'all_possible_moves', 'Bishop.all_possible_moves', False),
+    ('Queen', 'all_possible_moves', 'Queen.all_possible_moves', False),
+    ('King', 'all_possible_moves', 'King.all_possible_moves', False),
+    (None, 'check_then_move', 'turn.check_then_move', True),
+    ('Engine', 'choose_move', 'turn.Engine.choose_move', True),
+]
+
+# Lines in Board.to_text()
+BOARD_TEXT_LINES = 18
+
+# Colors the players see for each team
+TEAM_COLORS = {'white': 'blue', 'black': 'red'}
+
+# Quickest checkmate on this board, used by run_loopback_games()
+LOOPBACK_GAME = ["c7 to c6", "d2 to d4", "b7 to b5", "e1 to a5"]
+
+# Standard algebraic notation: piece letter, optional column and row of the piece, capture, destination, promotion
+SAN_PATTERN = re.compile(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQnbrq]))?$')
+PGN_TAG_PATTERN = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+PGN_TOKEN_PATTERN = re.compile(r'[{};()]|[^\s{};()]+')
+PGN_RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+# Board.encode(): 32 bytes of nibbles, flags, en passant column, halfmove clock, fullmove number
+POSITION_STRUCT = struct.Struct('<32sBBBH')
+POSITION_SIZE = POSITION_STRUCT.size
+
+# The starting board of this game (king and queen swap places compared to standard chess)
+STARTING_FEN = 'rnbkqbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBKQBNR w - - 0 1'
+
+# Number of (position, team) move lists each board remembers. Only the turn being played is looked up again,
+# so two is enough for the side to move plus one check of the other team, without keeping old lists alive
+MOVE_CACHE_SIZE = 2
+
+# Material value of each piece in centipawns
+PIECE_VALUES = {Pawn: 100, Knight: 320, Bishop: 330, Rook: 500, Queen: 900, King: 0}
+
+# Piece-square tables, seen from white's side (row 0 is where white's pawns are heading, white's king starts in column 3)
+PIECE_SQUARE_TABLES = {
+    Pawn: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+         50,  50,  50,  50,  50,  50,  50,  50,
+         10,  10,  20,  30,  30,  20,  10,  10,
+          5,   5,  10,  25,  25,  10,   5,   5,
+          0,   0,   0,  20,  20,   0,   0,   0,
+          5,  -5, -10,   0,   0, -10,  -5,   5,
+          5,  10,  10, -20, -20,  10,  10,   5,
+          0,   0,   0,   0,   0,   0,   0,   0,
+    ],
+    Knight: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20,   0,   0,   0,   0, -20, -40,
+        -30,   0,  10,  15,  15,  10,   0, -30,
+        -30,   5,  15,  20,  20,  15,   5, -30,
+        -30,   0,  15,  20,  20,  15,   0, -30,
+        -30,   5,  10,  15,  15,  10,   5, -30,
+        -40, -20,   0,   5,   5,   0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    Bishop: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,  10,  10,   5,   0, -10,
+        -10,   5,   5,  10,  10,   5,   5, -10,
+        -10,   0,  10,  10,  10,  10,   0, -10,
+        -10,  10,  10,  10,  10,  10,  10, -10,
+        -10,   5,   0,   0,   0,   0,   5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    Rook: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+          5,  10,  10,  10,  10,  10,  10,   5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+          0,   0,   0,   5,   5,   0,   0,   0,
+    ],
+    Queen: [
+        -20, -10, -10,  -5,  -5, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,   5,   5,   5,   0, -10,
+         -5,   0,   5,   5,   5,   5,   0,  -5,
+         -5,   0,   5,   5,   5,   5,   0,  -5,
+        -10,   0,   5,   5,   5,   5,   0, -10,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -20, -10, -10,  -5,  -5, -10, -10, -20,
+    ],
+    King: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+         20,  20,   0,   0,   0,   0,  20,  20,
+         20,  30,  10,   0,   0,  10,  30,  20,
+    ],
+}
+
+# The king should come to the middle once the queens and most pieces are gone
+KING_ENDGAME_TABLE = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10,   0,   0, -10, -20, -30,
+    -30, -10,  20,  30,  30,  20, -10, -30,
+    -30, -10,  30,  40,  40,  30, -10, -30,
+    -30, -10,  30,  40,  40,  30, -10, -30,
+    -30, -10,  20,  30,  30,  20, -10, -30,
+    -30, -30,   0,   0,   0,   0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+]
+
+# Material plus piece-square score of each piece on each space, positive for white and negative for black.
+# Black reads the tables upside down
+OPENING_SCORES = {}
+ENDGAME_SCORES = {}
+for score_type in PIECE_SQUARE_TABLES:
+    for score_team, score_sign in (('white', 1), ('black', -1)):
+        opening_table = PIECE_SQUARE_TABLES[score_type]
+        endgame_table = KING_ENDGAME_TABLE if score_type is King else opening_table
+        OPENING_SCORES[(score_team, score_type)] = []
+        ENDGAME_SCORES[(score_team, score_type)] = []
+        for score_square in range(64):
+            table_square = score_square if score_team == 'white' else (7 - score_square // 8) * 8 + score_square % 8
+            OPENING_SCORES[(score_team, score_type)].append(score_sign * (PIECE_VALUES[score_type] + opening_table[table_square]))
+            ENDGAME_SCORES[(score_team, score_type)].append(score_sign * (PIECE_VALUES[score_type] + endgame_table[table_square]))
+
+# How much each piece counts towards it still being the opening. The opening score is used in full at GAME_PHASE_TOTAL
+GAME_PHASE_WEIGHTS = {Pawn: 0, Knight: 1, Bishop: 1, Rook: 2, Queen: 4, King: 0}
+GAME_PHASE_TOTAL = 24
+
+# Centipawns per space a piece threatens
+MOBILITY_WEIGHTS = {Knight: 4, Bishop: 5, Rook: 2, Queen: 1}
+
+# Pawn structure, as (opening, endgame) centipawns. Passed pawn bonuses are indexed by rows left to go
+DOUBLED_PAWN_PENALTY = (10, 20)
+ISOLATED_PAWN_PENALTY = (10, 15)
+PASSED_PAWN_BONUS = ([0, 60, 40, 25, 15, 10, 5, 0], [0, 120, 80, 50, 30, 15, 10, 0])
+COLUMN_MASKS = [sum(1 << (mask_row * 8 + mask_column) for mask_row in range(8)) for mask_column in range(8)]
+ADJACENT_COLUMN_MASKS = [(COLUMN_MASKS[mask_column - 1] if mask_column > 0 else 0) |
+                         (COLUMN_MASKS[mask_column + 1] if mask_column < 7 else 0) for mask_column in range(8)]
+
+# Spaces in front of a pawn, in its own and the next columns, where an enemy pawn would stop it being passed
+PASSED_PAWN_MASKS = {'white': [], 'black': []}
+for mask_square in range(64):
+    mask_row, mask_column = SQUARE_COORDS[mask_square]
+    for mask_team, mask_rows in (('white', range(0, mask_row)), ('black', range(mask_row + 1, 8))):
+        PASSED_PAWN_MASKS[mask_team].append(sum(1 << (ahead_row * 8 + ahead_column) for ahead_row in mask_rows
+                                                for ahead_column in range(max(mask_column - 1, 0), min(mask_column + 2, 8))))
+
+# King safety: pawns on the two rows in front of the king, and the king's column and the ones next to it
+KING_SHELTER_BONUS = 10
+OPEN_KING_COLUMN_PENALTY = 15
+KING_SHELTER_MASKS = {'white': [], 'black': []}
+KING_COLUMN_MASKS = []
+for mask_square in range(64):
+    mask_row, mask_column = SQUARE_COORDS[mask_square]
+    shelter_columns = range(max(mask_column - 1, 0), min(mask_column + 2, 8))
+    for mask_team, shelter_rows in (('white', (mask_row - 1, mask_row - 2)), ('black', (mask_row + 1, mask_row + 2))):
+        KING_SHELTER_MASKS[mask_team].append(sum(1 << (shelter_row * 8 + shelter_column) for shelter_row in shelter_rows
+                                                 if 0 <= shelter_row <= 7 for shelter_column in shelter_columns))
+    KING_COLUMN_MASKS.append([COLUMN_MASKS[shelter_column] for shelter_column in shelter_columns])
+
+# Scores of pawn structures seen so far, keyed by (white pawns, black pawns)
+PAWN_STRUCTURE_CACHE = {}
+PAWN_STRUCTURE_CACHE_SIZE = 1 << 16
+
+# Small ints used for pieces and teams in Board.squares. A code is the piece type plus the team
+PIECE_CODES = {Pawn: 1, Knight: 2, Bishop: 3, Rook: 4, Queen: 5, King: 6}
+TEAM_CODES = {'white': 0, 'black': 8}
+CODE_TYPES = [None, Pawn, Knight, Bishop, Rook, Queen, King, None] * 2
+CODE_VALUES = [PIECE_VALUES.get(piece_type, 0) for piece_type in CODE_TYPES]
+
+# How far a pawn of each team moves forward in squares (8 per row)
+PAWN_STEPS = {'white': -8, 'black': 8}
+
+# Search scores. Mates are scored MATE_SCORE minus the number of moves it takes
+MATE_SCORE = 100000
+INFINITE_SCORE = 1000000
+
+# Bound types stored in the transposition table
+BOUND_NONE = 0
+BOUND_EXACT = 1
+BOUND_LOWER = 2
+BOUND_UPPER = 3
+
+# Random numbers for Zobrist hashing, one per piece type, team and space, plus one for black to move.
+# The seed is fixed so a position has the same hash in every run
+ZOBRIST_RANDOM = random.Random(20200531)
+ZOBRIST_PIECE_KEYS = {}
+for zobrist_team in ('white', 'black'):
+    for zobrist_type in (Pawn, Rook, Knight, Bishop, Queen, King):
+        ZOBRIST_PIECE_KEYS[(zobrist_team, zobrist_type)] = [ZOBRIST_RANDOM.getrandbits(64) for _ in range(64)]
+ZOBRIST_BLACK_TO_MOVE = ZOBRIST_RANDOM.getrandbits(64)
+
+# Opening book file: magic and entry count, then (position hash, move code, weight) entries sorted by hash and move
+BOOK_MAGIC = b'ACBK'
+BOOK_HEADER = struct.Struct('<4sI')
+BOOK_ENTRY = struct.Struct('<QHH')
+
+# Tablebase files: magic and number of pieces, then one byte per position. Bytes other than these three are plies to checkmate + 1
+TABLEBASE_MAGIC = b'ACTB'
+TABLEBASE_HEADER = struct.Struct('<4sB3x')
+TABLEBASE_MAX_PIECES = 4
+TABLEBASE_DRAW = 0
+TABLEBASE_STALEMATE = 254
+TABLEBASE_ILLEGAL = 255
+
+# Row each team's pawns start on
+PAWN_STARTING_ROWS = {'white': 6, 'black': 1}
+
+# (name, FEN, {depth: node count})
+# This game has no castling or en passant, so only positions where neither can happen at the
+# listed depths are used. Counts are the published ones for the standard perft positions.
+# The starting board has the king and queen swapped, a mirror image of the standard one, so the counts are the same
+PERFT_SUITE = [
+    ("start position", STARTING_FEN, {1: 20, 2: 400, 3: 8902, 4: 197281}),
+    # 2812 at depth 3 includes 2 en passant captures
+    ("position 3", '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', {1: 14, 2: 191, 3: 2810}),
+    ("position 6", 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 1', {1: 46, 2: 2079, 3: 89890}),
+    ("promote out of check", '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1', {1: 11, 2: 133, 3: 1442, 4: 19174, 6: 3821001}),
+    ("discovered check", '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1', {5: 1004658}),
+    ("promote to give check", '4k3/1P6/8/8/8/8/K7/8 w - - 0 1', {6: 217342}),
+    ("underpromote to check", '8/P1k5/K7/8/8/8/8/8 w - - 0 1', {6: 92683}),
+    ("self stalemate", 'K1k5/8/P7/8/8/8/8/8 w - - 0 1', {1: 2, 2: 6, 3: 13, 4: 63, 5: 382, 6: 2217}),
+    ("stalemate and checkmate", '8/k1P5/8/1K6/8/8/8/8 w - - 0 1', {7: 567584}),
+    ("stalemate and checkmate 2", '8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1', {1: 37, 2: 183, 3: 6559, 4: 23527}),
+]
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Chess that can be played in a terminal")
+    parser.add_argument("--perft", type=int, metavar="DEPTH", help="count the moves from the starting board to DEPTH and exit")
+    parser.add_argument("--perft-suite", action="store_true", help="check the move generator against known perft counts and exit")
+    parser.add_argument("--encoding-suite", action="store_true", help="check that positions come back the same from Board.encode() and Board.decode() and exit")
+    parser.add_argument("--movegen-suite", action="store_true", help="check every piece's legal moves against making each move and looking for a check, and exit")
+    parser.add_argument("--evaluation-suite", action="store_true", help="check the board's running evaluation totals against working them out from scratch and exit")
+    parser.add_argument("--max-nodes", type=int, help="skip perft suite counts larger than this")
+    parser.add_argument("--computer", choices=["blue", "red"], help="let the computer play blue or red")
+    parser.add_argument("--think-time", type=float, default=2.0, help="seconds the computer thinks per move")
+    parser.add_argument("--workers", type=int, default=1, help="processes the computer searches with")
+    parser.add_argument("--display", choices=["full", "diff"], default="full",
+                        help="reprint the whole board every turn, or redraw only the spaces that changed (needs an ANSI terminal)")
+    parser.add_argument("--book", metavar="FILE", help="opening book the computer plays from")
+    parser.add_argument("--build-book", nargs="+", metavar="PGN", help="build the --book file from PGN files and exit")
+    parser.add_argument("--tablebases", metavar="DIR", help="directory of endgame tablebase files for the computer")
+    parser.add_argument("--generate-tablebase", nargs="+", metavar="SIGNATURE", help="write tablebases (i.e. KQvK KRvK KPvK) to the --tablebases directory and exit")
+    parser.add_argument("--pgn", metavar="FILE", help="add every finished game to FILE as PGN")
+    parser.add_argument("--replay-pgn", metavar="FILE", help="replay every game in a PGN file, report invalid games and speed, and exit")
+    parser.add_argument("--script", metavar="FILE", help="play the moves in FILE ('-' for standard input) without drawing the board, print each game's result as JSON and exit")
+    parser.add_argument("--script-moves", action="store_true", help="with --script, also print a JSON line for every move")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="serve games over TCP on PORT instead of playing here")
+    parser.add_argument("--host", default="127.0.0.1", help="address --serve listens on")
+    parser.add_argument("--loopback-games", type=int, metavar="N", help="play N games at once against a local server and exit")
+    parser.add_argument("--stats", metavar="FILE", help="time the hot paths and write the stats to FILE as JSON")
+    parser.add_argument("--stats-interval", type=float, default=10.0, help="seconds between --stats writes")
+    parser.add_argument("--parallel-benchmark", type=int, metavar="DEPTH", help="compare searching to DEPTH with one process and with --workers processes and exit")
+    args = parser.parse_args()
+
+    instrumentation = None
+    if args.stats:
+        instrumentation = Instrumentation(args.stats, args.stats_interval)
+        instrumentation.enable()
+
+    try:
+        if args.perft:
+            perft_board = Board()
+            initialize_board(perft_board)
+            run_perft(perft_board, 'white', args.perft)
+        elif args.perft_suite:
+            if not run_perft_suite(args.max_nodes):
+                raise SystemExit(1)
+        elif args.encoding_suite:
+            if not run_encoding_suite():
+                raise SystemExit(1)
+        elif args.movegen_suite:
+            if not run_movegen_suite():
+                raise SystemExit(1)
+        elif args.evaluation_suite:
+            if not run_evaluation_suite():
+                raise SystemExit(1)
+        elif args.parallel_benchmark:
+            compare_parallel_search(args.parallel_benchmark, args.workers)
+        elif args.serve is not None:
+            run_server(args.host, args.serve, {"blue": "white", "red": "black", None: None}[args.computer], args.think_time, args.workers)
+        elif args.loopback_games:
+            if not run_loopback_games(args.loopback_games):
+                raise SystemExit(1)
+        elif args.generate_tablebase:
+            if not args.tablebases:
+                parser.error("--generate-tablebase needs --tablebases DIR to write to")
+            for signature in args.generate_tablebase:
+                start_time = time.perf_counter()
+                generate_tablebase(signature, args.tablebases)
+                print(f"{signature} done in {time.perf_counter() - start_time:.1f}s")
+        elif args.build_book:
+            if not args.book:
+                parser.error("--build-book needs --book FILE to write to")
+            print(f"{build_opening_book(args.build_book, args.book)} book entries written to {args.book}")
+        elif args.script:
+            if not run_script(args.script, args.script_moves):
+                raise SystemExit(1)
+        elif args.replay_pgn:
+            if not run_pgn_replay(args.replay_pgn):
+                raise SystemExit(1)
+        else:
+            main({"blue": "white", "red": "black", None: None}[args.computer], args.think_time, args.workers, args.pgn, args.display, args.book, args.tablebases)
+    finally:
+        if instrumentation:
+            instrumentation.disable()
+            instrumentation.dump()